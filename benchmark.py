@@ -0,0 +1,255 @@
+#!/usr/bin/python3
+
+# Headless benchmark harness for the four solvers.
+#
+#   python3 benchmark.py --output bench.json                  # run everything at every scale
+#   python3 benchmark.py --save-baseline bench_baseline.json  # record a baseline on this machine
+#   python3 benchmark.py --baseline bench_baseline.json       # flag anything slower/bigger than the baseline
+#   python3 benchmark.py --metrics --output bench.json        # also record the solvers' operation counters
+#
+# Every input is generated from a fixed seed, so two runs at the same scale do exactly the same work.
+# Each benchmark also records a checksum of its answer, and a checksum that doesn't match the baseline
+# counts as a regression too.
+
+import argparse
+import json
+import math
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+import instrumentation
+
+SEED = 312
+
+# Problem sizes for each benchmark at each scale
+SCALES = {
+    'prime_test':            {'small': 2000, 'medium': 20000, 'large': 200000},   # 64-bit candidates
+    'convex_hull':           {'small': 1000, 'medium': 10000, 'large': 100000},   # points
+    'shortest_paths_heap':   {'small': 1000, 'medium': 10000, 'large': 100000},   # nodes
+    'shortest_paths_array':  {'small': 500,  'medium': 2000,  'large': 5000},     # nodes (O(V^2))
+    'align_unbanded':        {'small': 300,  'medium': 1000,  'large': 3000},     # characters per sequence
+    'align_banded':          {'small': 1000, 'medium': 10000, 'large': 100000},   # characters per sequence
+}
+
+DEFAULT_TOLERANCE = 0.25  # fractional slowdown (or memory growth) allowed before it counts as a regression
+PRIME_TEST_K = 20
+EDGES_PER_NODE = 3
+
+
+# ---- input generators ----
+
+def random_sequence(rng, length):
+    return ''.join(rng.choice('ACGT') for i in range(length))
+
+
+# A sequence with roughly one edit every 20 characters, so banded alignments of the two stay in the band
+def mutate_sequence(rng, seq):
+    letters = list(seq)
+    for i in range(len(letters) // 20):
+        pos = rng.randrange(len(letters))
+        choice = rng.random()
+        if choice < 0.5:
+            letters[pos] = rng.choice('ACGT')
+        elif choice < 0.75:
+            letters.insert(pos, rng.choice('ACGT'))
+        elif len(letters) > 1:
+            del letters[pos]
+    return ''.join(letters)
+
+
+def random_points(rng, n):
+    from PyQt5.QtCore import QPointF
+    return [QPointF(rng.uniform(-1.0, 1.0), rng.uniform(-1.0, 1.0)) for i in range(n)]
+
+
+# Same shape of network the GUI builds: random points, each with a few outgoing edges
+# weighted by the distance between the endpoints
+def random_network(rng, n):
+    from PyQt5.QtCore import QPointF
+    from CS312Graph import CS312Graph
+    locs = [QPointF(rng.uniform(-1.0, 1.0), rng.uniform(-1.0, 1.0)) for i in range(n)]
+    edges = []
+    for i in range(n):
+        neighbors = rng.sample(range(n), min(EDGES_PER_NODE + 1, n))
+        edges.append([(j, 100.0 * math.hypot(locs[i].x() - locs[j].x(), locs[i].y() - locs[j].y()))
+                      for j in neighbors if j != i][:EDGES_PER_NODE])
+    return CS312Graph(locs, edges)
+
+
+# ---- benchmarks ----
+# Each one takes (rng, size) and returns (setup, run, items): setup() builds fresh inputs outside the timer,
+# run(inputs) is the timed part and returns a checksum of its answer, items is what throughput is counted in
+
+def bench_prime_test(rng, size):
+    from fermat import prime_test
+    candidates = [rng.getrandbits(64) | 1 for i in range(size)]
+
+    def run(inputs):
+        return sum(1 for N in inputs if prime_test(N, PRIME_TEST_K) == 'prime')
+
+    return (lambda: candidates), run, size
+
+
+def bench_convex_hull(rng, size):
+    from convex_hull import ConvexHullSolver
+    points = random_points(rng, size)
+
+    def run(inputs):
+        solver = ConvexHullSolver(None)
+        hull = solver.makeConvex(sorted(inputs, key=lambda pt: pt.x()))
+        return len(hull)
+
+    return (lambda: list(points)), run, size
+
+
+def bench_shortest_paths(use_heap):
+    def bench(rng, size):
+        from network_routing_solver import NetworkRoutingSolver
+        seed = rng.getrandbits(32)
+
+        # every run gets a freshly built solver, so its shortest path tree cache can't turn timed runs into cache hits
+        def setup():
+            solver = NetworkRoutingSolver(None)
+            solver.initializeNetwork(random_network(random.Random(seed), size))
+            return solver
+
+        def run(solver):
+            solver.computeShortestPaths(0, use_heap)
+            return round(solver.getShortestPath(size - 1)['cost'], 6)
+
+        return setup, run, size
+    return bench
+
+
+def bench_align(banded):
+    def bench(rng, size):
+        from gene_sequencing import GeneSequencing
+        seq1 = random_sequence(rng, size)
+        seq2 = mutate_sequence(rng, seq1)
+
+        def run(pair):
+            solver = GeneSequencing()
+            cost, backPtrs = solver.calcAlignCost(pair[0], pair[1], banded, size)
+            return cost
+
+        return (lambda: (seq1, seq2)), run, size
+    return bench
+
+
+BENCHMARKS = {
+    'prime_test': bench_prime_test,
+    'convex_hull': bench_convex_hull,
+    'shortest_paths_heap': bench_shortest_paths(True),
+    'shortest_paths_array': bench_shortest_paths(False),
+    'align_unbanded': bench_align(False),
+    'align_banded': bench_align(True),
+}
+
+
+# ---- harness ----
+
+# Runs one benchmark: best wall time over `repeats` runs, then one more run under tracemalloc for peak memory
+# (kept separate because tracemalloc slows everything down). With metrics, one last run with instrumentation
+# on records the solvers' counters too - again separately, so the counting never shows up in the times.
+def measure(name, scale, repeats, metrics=False):
+    size = SCALES[name][scale]
+    setup, run, items = BENCHMARKS[name](random.Random(SEED), size)
+
+    best = float('inf')
+    checksum = None
+    for i in range(repeats):
+        inputs = setup()
+        start = time.perf_counter()
+        checksum = run(inputs)
+        best = min(best, time.perf_counter() - start)
+
+    inputs = setup()
+    tracemalloc.start()
+    try:
+        run(inputs)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    result = {'size': size, 'seconds': best, 'peak_bytes': peak,
+              'throughput': items / best if best > 0 else float('inf'), 'checksum': checksum}
+    if metrics:
+        inputs = setup()
+        instrumentation.reset()
+        instrumentation.enable()
+        try:
+            run(inputs)
+        finally:
+            instrumentation.disable()
+        result['metrics'] = instrumentation.export()
+    return result
+
+
+def run_benchmarks(names, scales, repeats, metrics=False):
+    results = {}
+    for name in names:
+        for scale in scales:
+            key = '{}[{}]'.format(name, scale)
+            results[key] = measure(name, scale, repeats, metrics)
+            print('{:32s} {:10.4f} s  {:10.1f} KiB peak  {:12.1f} items/s'.format(
+                key, results[key]['seconds'], results[key]['peak_bytes'] / 1024.0, results[key]['throughput']))
+    return {'python': platform.python_version(), 'machine': platform.machine(), 'seed': SEED,
+            'benchmarks': results}
+
+
+# Returns a list of human readable regressions of `current` against `baseline`
+def compare(current, baseline, tolerance):
+    regressions = []
+    for key, now in current['benchmarks'].items():
+        before = baseline.get('benchmarks', {}).get(key)
+        if before is None:
+            continue
+        if before.get('checksum') != now['checksum']:
+            regressions.append('{}: answer changed ({} -> {})'.format(key, before.get('checksum'), now['checksum']))
+        if now['seconds'] > before['seconds'] * (1 + tolerance):
+            regressions.append('{}: {:.4f} s -> {:.4f} s ({:+.0%})'.format(
+                key, before['seconds'], now['seconds'], now['seconds'] / before['seconds'] - 1))
+        if now['peak_bytes'] > before['peak_bytes'] * (1 + tolerance):
+            regressions.append('{}: peak memory {} -> {} bytes ({:+.0%})'.format(
+                key, before['peak_bytes'], now['peak_bytes'], now['peak_bytes'] / max(before['peak_bytes'], 1) - 1))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the CS312 solvers')
+    parser.add_argument('--only', nargs='+', choices=sorted(BENCHMARKS), default=sorted(BENCHMARKS),
+                        help='benchmarks to run (default: all)')
+    parser.add_argument('--scales', nargs='+', choices=['small', 'medium', 'large'], default=['small', 'medium', 'large'])
+    parser.add_argument('--repeats', type=int, default=3, help='timed runs per benchmark, the best one is kept')
+    parser.add_argument('--metrics', action='store_true',
+                        help="also record the solvers' operation counters (one extra run per benchmark)")
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare against this JSON file and exit 1 on any regression')
+    parser.add_argument('--save-baseline', help='write the results to this JSON file as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='allowed fractional slowdown/memory growth (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.only, args.scales, args.repeats, args.metrics)
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print('REGRESSION: ' + regression)
+        if regressions:
+            return 1
+        print('No regressions against {}'.format(args.baseline))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
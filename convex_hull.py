@@ -1,81 +1,266 @@
 #!/usr/bin/python3
 
-from which_pyqt import PYQT_VER
-if PYQT_VER == 'PYQT5':
-    from PyQt5.QtCore import QLineF, QPointF
-#elif PYQT_VER == 'PYQT4':
-#    from PyQt4.QtCore import QLineF, QPointF
-else:
-    raise Exception('Unsupported Version of PyQt: {}'.format(PYQT_VER))
-
-
-
+# PyQt is only needed at the GUI boundary (compute_hull) - the hull engine itself runs on plain coordinates,
+# so this module still imports on machines without PyQt installed
+try:
+    from which_pyqt import PYQT_VER
+    if PYQT_VER == 'PYQT5':
+        from PyQt5.QtCore import QLineF, QPointF
+    #elif PYQT_VER == 'PYQT4':
+    #    from PyQt4.QtCore import QLineF, QPointF
+    else:
+        raise Exception('Unsupported Version of PyQt: {}'.format(PYQT_VER))
+except ImportError:
+    QLineF = None
+    QPointF = None
+
+
+
+import math
+import os
+import random
 import time
+from bisect import bisect_right
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from fractions import Fraction
+from multiprocessing.shared_memory import SharedMemory
+from instrumentation import METRICS, captured
+
+# Relative error bound for the floating point orientation test (Shewchuk's ccwerrboundA) -
+# anything closer to 0 than this gets recomputed exactly
+ORIENTATION_ERROR_BOUND = (3.0 + 16.0 * 2.0 ** -53) * 2.0 ** -53
+
+# Below this many points the parallel hull isn't worth starting a process pool for
+PARALLEL_MIN_POINTS = 50000
+# How many x values per chunk are sampled to pick the chunk boundaries
+SPLITTER_SAMPLES_PER_CHUNK = 64
+
+# 'divide' is the divide and conquer merge (makeConvexRange), 'monotone' is Andrew's monotone chain,
+# 'quickhull' and 'chan' are output sensitive, and 'auto' picks one from n and a sampled estimate of h
+HULL_ALGORITHMS = ('divide', 'monotone', 'quickhull', 'chan', 'auto')
+# 'auto' builds the hull of this many sampled points to estimate how many of the points are on the hull
+AUTO_SAMPLE_SIZE = 1000
 
 class ConvexHullSolver:
-    def __init__( self, display ):
+    # workers > 1 sorts the points and builds the leaf hulls in a process pool (for inputs of PARALLEL_MIN_POINTS+)
+    # algorithm is one of HULL_ALGORITHMS - every one of them gives exactly the same hull
+    def __init__( self, display=None, workers=1, algorithm='divide' ):
+        if algorithm not in HULL_ALGORITHMS:
+            raise ValueError('Unknown hull algorithm: {}'.format(algorithm))
         self.points = None
         self.gui_display = display
+        self.workers = workers
+        self.algorithm = algorithm
+        # sorted (by x, then y), de-duplicated coordinates of the points the current hull is being built from -
+        # every hull inside the solver is a list of indices into these, clockwise from the leftmost point
+        self.xs = []
+        self.ys = []
 
     # Main function called by the GUI - generates points, sorts them, and calls the makeConvex solver
+    @captured('compute_hull')
     def compute_hull( self, unsorted_points ):
         assert( type(unsorted_points) == list and type(unsorted_points[0]) == QPointF )
 
         n = len(unsorted_points)
-        print( '>>Computing Hull for set of {} points'.format(n) )
-
-        t1 = time.time()
-        sorted_points = sorted(unsorted_points, key=lambda pt: pt.x())
-        t2 = time.time()
-        print('Time Elapsed (Sorting): {:3.8f} sec'.format(t2-t1))
-
-        t3 = time.time()
-        convexHullPoints = self.makeConvex(sorted_points)
-        t4 = time.time()
-
-        # Create QLineFs from the convex hull points and send them all to the GUI
+        if METRICS.enabled:
+            METRICS.count('hull.points', n)
+
+        if self.algorithm != 'divide' or self.useParallel(n):
+            # these sort (if they sort at all) as part of building the hull, so there's no separate sorting time
+            t3 = time.time()
+            order, hullIndices = self.solve(unsorted_points)
+            t4 = time.time()
+        else:
+            with METRICS.phase('hull.sort'):
+                order = self.loadSortedPoints(unsorted_points)
+
+            t3 = time.time()
+            hullIndices = self.makeConvexRange(0, len(order))
+            t4 = time.time()
+
+        # Only now go back to QPointFs - create QLineFs from the convex hull points and send them all to the GUI
+        convexHullPoints = [unsorted_points[order[i]] for i in hullIndices]
         convexHullLines = []
-        for i in range(len(convexHullPoints)):
-            convexHullLines.append(QLineF(convexHullPoints[i], convexHullPoints[(i + 1) % len(convexHullPoints)]))
+        if len(convexHullPoints) == 2:
+            # a flat hull is a single segment, not a segment drawn there and back
+            convexHullLines.append(QLineF(convexHullPoints[0], convexHullPoints[1]))
+        else:
+            for i in range(len(convexHullPoints)):
+                convexHullLines.append(QLineF(convexHullPoints[i], convexHullPoints[(i + 1) % len(convexHullPoints)]))
 
         self.gui_display.addLines(convexHullLines, (0, 0, 255))
 
-        print('Time Elapsed (Convex Hull): {:3.8f} sec'.format(t4-t3))
         self.gui_display.displayStatusText('Time Elapsed (Convex Hull): {:3.8f} sec'.format(t4-t3))
         self.gui_display.update()
 
 
-    # Recursively splits the given pointsList in half, and sorts it in CW order when the list is <= 3 points long
+    # Headless entry point - points can be an (n, 2) NumPy array, a flat array('d') of x0, y0, x1, y1, ...,
+    # or a list of (x, y) pairs or QPointFs. Returns the hull as indices into points, in clockwise order.
+    def convexHullIndices( self, points ):
+        order, hullIndices = self.solve(points)
+        return [order[i] for i in hullIndices]
+
+
+    # Runs the selected algorithm. Returns (the indices into points the solver kept, the hull as positions in that)
+    def solve( self, points ):
+        algorithm = self.algorithm
+        if algorithm == 'divide' and self.useParallel(len(points)):
+            return self.parallelHull(points)
+
+        xs, ys = self.loadCoordinates(points)
+        if algorithm == 'auto':
+            algorithm = self.chooseAlgorithm(xs, ys)
+
+        if algorithm == 'divide':
+            order = self.keepSortedUnique(xs, ys)
+            return order, self.makeConvexRange(0, len(order))
+        if algorithm == 'monotone':
+            order = self.keepSortedUnique(xs, ys)
+            return order, self.monotoneChain(range(len(order)))
+        order = self.keepUnique(xs, ys)
+        if algorithm == 'quickhull':
+            return order, self.quickHull()
+        return order, self.chanHull()
+
+
+    # Picks an algorithm for 'auto' from the hull of a random sample: when a good share of the sample is on its
+    # hull, h is close to n and the plain O(n log n) monotone chain wins; otherwise h is small and QuickHull
+    # throws most of the points away on its first pass. Tiny inputs aren't worth sampling.
+    def chooseAlgorithm( self, xs, ys ):
+        n = len(xs)
+        if n <= AUTO_SAMPLE_SIZE:
+            return 'monotone'
+        sample = random.Random(n).sample(range(n), AUTO_SAMPLE_SIZE)
+        sampleSolver = ConvexHullSolver(algorithm='monotone')
+        h = len(sampleSolver.convexHullIndices([(xs[i], ys[i]) for i in sample]))
+        return 'monotone' if h > AUTO_SAMPLE_SIZE // 10 else 'quickhull'
+
+
+    def useParallel( self, n ):
+        return (self.workers is None or self.workers > 1) and n >= PARALLEL_MIN_POINTS
+
+
+    # Parallel sort + divide and conquer. The coordinates go into shared memory, the x axis is cut into one
+    # contiguous slab per worker (boundaries picked from a sample so the slabs come out about the same size),
+    # and each worker sorts its slab's points and builds their hull. The slab hulls are then merged pairwise
+    # with mergeHulls.
+    # Returns (sorted order as indices into points, hull as positions in that order), like the serial path.
+    def parallelHull( self, points ):
+        xs, ys = self.loadCoordinates(points)
+        n = len(xs)
+        workers = self.workers or os.cpu_count() or 1
+
+        # Slab k gets the points with splitters[k-1] <= x < splitters[k], so equal x's always share a slab
+        # and every slab sorts entirely before the next one
+        step = max(1, n // (workers * SPLITTER_SAMPLES_PER_CHUNK))
+        sample = sorted(xs[::step])
+        splitters = sorted(set(sample[len(sample) * k // workers] for k in range(1, workers)))
+        slabs = [[] for k in range(len(splitters) + 1)]
+        for i in range(n):
+            slabs[bisect_right(splitters, xs[i])].append(i)
+
+        shm = SharedMemory(create=True, size=max(16 * n, 1))
+        try:
+            coords = shm.buf.cast('d')
+            coords[:n] = array('d', xs)
+            coords[n:2 * n] = array('d', ys)
+            coords.release()
+
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                slabs = [pool.submit(_slabHull, shm.name, n, slab) for slab in slabs if slab]
+                slabs = [slab.result() for slab in slabs]
+        finally:
+            shm.close()
+            shm.unlink()
+
+        # Stitch the slabs' sorted orders together, shifting each slab's hull into the combined positions
+        order = []
+        hulls = []
+        for slabOrder, slabHull in slabs:
+            hulls.append([len(order) + i for i in slabHull])
+            order.extend(slabOrder)
+        self.xs = [xs[i] for i in order]
+        self.ys = [ys[i] for i in order]
+
+        while len(hulls) > 1:
+            merged = [self.mergeHulls(hulls[k], hulls[k + 1]) for k in range(0, len(hulls) - 1, 2)]
+            if len(hulls) % 2:
+                merged.append(hulls[-1])
+            hulls = merged
+        return order, (hulls[0] if hulls else [])
+
+
+    # Pulls the coordinates out of points into self.xs/self.ys, sorted by x then y with exact duplicates dropped,
+    # and returns the sorted order as indices into points
+    def loadSortedPoints( self, points ):
+        xs, ys = self.loadCoordinates(points)
+        return self.keepSortedUnique(xs, ys)
+
+    def keepSortedUnique( self, xs, ys ):
+        order = sorted(range(len(xs)), key=lambda i: (xs[i], ys[i]))
+
+        # duplicates are next to each other once sorted - keep the first of each
+        unique = []
+        for i in order:
+            if not unique or xs[i] != xs[unique[-1]] or ys[i] != ys[unique[-1]]:
+                unique.append(i)
+
+        self.xs = [xs[i] for i in unique]
+        self.ys = [ys[i] for i in unique]
+        return unique
+
+    # Same as keepSortedUnique, but without the sort - the points keep their input order (for the algorithms
+    # that never sort all n points). Of each set of duplicates the first one is kept, like the sorted version.
+    def keepUnique( self, xs, ys ):
+        first = {}
+        for i, point in enumerate(zip(xs, ys)):
+            first.setdefault(point, i)
+        unique = sorted(first.values())
+        self.xs = [xs[i] for i in unique]
+        self.ys = [ys[i] for i in unique]
+        return unique
+
+
+    # Splits points into a list of x's and a list of y's, whatever form they came in
+    def loadCoordinates( self, points ):
+        if isinstance(points, array):       # flat x0, y0, x1, y1, ...
+            return points[0::2].tolist(), points[1::2].tolist()
+        if hasattr(points, 'ndim'):         # (n, 2) NumPy array
+            return points[:, 0].tolist(), points[:, 1].tolist()
+        if len(points) > 0 and QPointF is not None and isinstance(points[0], QPointF):
+            return [pt.x() for pt in points], [pt.y() for pt in points]
+        return [pt[0] for pt in points], [pt[1] for pt in points]
+
+
+    # Takes a list of QPointFs (sorted by x) and returns the hull as QPointFs in CW order
     def makeConvex( self, pointsList ):
-       # print(">>MAKECONVEX(): starting")
-
-        # BASE CASE - 2 or 3 points
-        if len(pointsList) <= 3 :
-            # an array of 2 points will always be sorted CW, but an array of 3 points won't necessarily be sorted
-            if len(pointsList) == 3:
-                slope1 = self.findSlope(pointsList[0], pointsList[1])
-                slope2 = self.findSlope(pointsList[0], pointsList[2])
-                if slope2 > slope1:
-                    # swap points at pos 1 and pos 2
-                    temp = pointsList[2]
-                    pointsList[2] = pointsList[1]
-                    pointsList[1] = temp
-                elif pointsList[1].y() == pointsList[2].y():
-                    if pointsList[0].y() > pointsList[1].y():
-                        # swap points at pos 1 and pos 2
-                        temp = pointsList[2]
-                        pointsList[2] = pointsList[1]
-                        pointsList[1] = temp
-            return pointsList
-
-        # Split the points in half
-        half = len(pointsList) // 2
-        leftSidePoints = pointsList[:half] # from 0 to half
-        rightSidePoints = pointsList[half:] # If n is odd, rightSide will be 1 larger than leftSide
-
-        # Recurse until the list is 2 or 3 elements long (base cases)
-        leftHull = self.makeConvex(leftSidePoints)
-        rightHull = self.makeConvex(rightSidePoints)
+        order = self.loadSortedPoints(pointsList)
+        return [pointsList[order[i]] for i in self.makeConvexRange(0, len(order))]
+
+
+    # Recursively splits the sorted points in [lo, hi) in half, and sorts them in CW order when there are <= 3
+    # Works on index ranges, so nothing gets copied on the way down
+    def makeConvexRange( self, lo, hi ):
+
+        # BASE CASE - 1, 2 or 3 points
+        if hi - lo <= 3 :
+            if hi - lo < 3:
+                return list(range(lo, hi)) # 1 or 2 points are always in CW order
+            # 3 points: lo is the leftmost, so they're CW if lo+1 is on the right of lo -> lo+2
+            turn = self.orientation(lo, lo + 1, lo + 2)
+            if turn < 0:
+                return [lo, lo + 1, lo + 2]
+            if turn > 0:
+                return [lo, lo + 2, lo + 1]
+            return [lo, lo + 2] # collinear - the middle point (in sorted order) isn't a corner
+
+        # Split the points in half - if n is odd, the right side will be 1 larger than the left side
+        half = lo + (hi - lo) // 2
+
+        # Recurse until the range is 1 to 3 elements long (base cases)
+        leftHull = self.makeConvexRange(lo, half)
+        rightHull = self.makeConvexRange(half, hi)
 
         # Merge leftHull and rightHull
         mergedHull = self.mergeHulls(leftHull, rightHull)
@@ -83,93 +268,449 @@ class ConvexHullSolver:
         return mergedHull
 
 
-    # Given two hull arrays of QPointFs, merges the two hulls into one shape and returns the merged array
+    # Given two hulls (lists of point indices, CW from their leftmost point, with every point of leftHull
+    # sorting before every point of rightHull), merges them into one hull in O(len(leftHull) + len(rightHull))
     def mergeHulls(self, leftHull, rightHull):
 
         leftHullPivot_Index = self.findRightmostPoint(leftHull)
         rightHullPivot_Index = 0
 
-        leftHull_upperTan_index, rightHull_upperTan_index = self.findTangentPoints(leftHull, rightHull,leftHullPivot_Index, rightHullPivot_Index)
-        rightHull_lowerTan_index, leftHull_lowerTan_index = self.findTangentPoints(rightHull, leftHull, rightHullPivot_Index, leftHullPivot_Index)
+        leftHull_upperTan_index, rightHull_upperTan_index = self.findTangentPoints(leftHull, rightHull, leftHullPivot_Index, rightHullPivot_Index, True)
+        leftHull_lowerTan_index, rightHull_lowerTan_index = self.findTangentPoints(leftHull, rightHull, leftHullPivot_Index, rightHullPivot_Index, False)
 
-        leftHull_upperTan_index = leftHull_upperTan_index % len(leftHull)
-        leftHull_lowerTan_index = leftHull_lowerTan_index #% len(leftHull)
-        rightHull_upperTan_index = rightHull_upperTan_index % len(rightHull)
-        rightHull_lowerTan_index = rightHull_lowerTan_index % len(rightHull)
-
-        # Merge the two arrays in clockwise order
-        mergedHull = leftHull[0:leftHull_upperTan_index+1]
-        mergedHull += (rightHull[rightHull_upperTan_index:rightHull_lowerTan_index+1])
-        # Special cases for when the index is 0
-        if rightHull_lowerTan_index == 0:
-            mergedHull += rightHull[rightHull_upperTan_index:]
-            mergedHull.append(rightHull[0])
-
-        if not leftHull_lowerTan_index == 0:
-            mergedHull += (leftHull[leftHull_lowerTan_index:])
+        # Walk clockwise: leftHull from its leftmost point to the upper tangent, across to rightHull,
+        # around rightHull to the lower tangent, back across, and around leftHull to where we started
+        mergedHull = leftHull[:leftHull_upperTan_index + 1]
+        if rightHull_lowerTan_index >= rightHull_upperTan_index:
+            mergedHull.extend(rightHull[rightHull_upperTan_index:rightHull_lowerTan_index + 1])
+        else:
+            mergedHull.extend(rightHull[rightHull_upperTan_index:])
+            mergedHull.extend(rightHull[:rightHull_lowerTan_index + 1])
+        if leftHull_lowerTan_index != 0:
+            mergedHull.extend(leftHull[leftHull_lowerTan_index:])
 
         return mergedHull
 
-    # Finds the upper and lower tangent points for a given left/right hull,
-    # depending on what order the hulls/pivot_Indices are passed in
-    def findTangentPoints(self, leftHull, rightHull, leftHullPivot_Index, rightHullPivot_Index):
-
-        currSlope = self.findSlope(leftHull[leftHullPivot_Index], rightHull[rightHullPivot_Index])
+    # Finds the upper (or lower) tangent between leftHull and rightHull, starting from the given pivots,
+    # and returns the (leftHull index, rightHull index) of its endpoints
+    # The upper tangent walks leftHull counterclockwise and rightHull clockwise, the lower one the other way round
+    def findTangentPoints(self, leftHull, rightHull, leftHullPivot_Index, rightHullPivot_Index, upper):
+        side = 1 if upper else -1
+        leftLen = len(leftHull)
+        rightLen = len(rightHull)
+        steps = 0
         updateNeeded = True
 
         while updateNeeded:
             updateNeeded = False
 
-            left_slope_decreasing = True
-            while left_slope_decreasing:
-                potentialLeftHullPivot_index = leftHullPivot_Index - 1
-                if potentialLeftHullPivot_index < 0:
-                    potentialLeftHullPivot_index = len(leftHull) - 1
-
-                nextSlope = self.findSlope(leftHull[potentialLeftHullPivot_index], rightHull[rightHullPivot_Index])
-
-                if nextSlope > currSlope:
-                    left_slope_decreasing = False
-                else:
-                    updateNeeded = True
-                    leftHullPivot_Index = potentialLeftHullPivot_index
-                    currSlope = nextSlope
-
-            right_slope_increasing = True
-            while right_slope_increasing:
-                potentialRightHullPivot_index = rightHullPivot_Index + 1
-                if potentialRightHullPivot_index == len(rightHull):
-                    potentialRightHullPivot_index = 0
-
-                nextSlope = self.findSlope(leftHull[leftHullPivot_Index], rightHull[potentialRightHullPivot_index])
-
-                if nextSlope < currSlope:
-                    right_slope_increasing = False
-                else:
-                    updateNeeded = True
-                    rightHullPivot_Index = potentialRightHullPivot_index
-                    currSlope = nextSlope
-
+            while leftLen > 1:
+                potentialLeftHullPivot_index = (leftHullPivot_Index - side) % leftLen
+                if not self.isOutsideTangent(leftHull[leftHullPivot_Index], rightHull[rightHullPivot_Index],
+                                             leftHull[potentialLeftHullPivot_index], side, True):
+                    break
+                updateNeeded = True
+                leftHullPivot_Index = potentialLeftHullPivot_index
+                steps += 1
+
+            while rightLen > 1:
+                potentialRightHullPivot_index = (rightHullPivot_Index + side) % rightLen
+                if not self.isOutsideTangent(leftHull[leftHullPivot_Index], rightHull[rightHullPivot_Index],
+                                             rightHull[potentialRightHullPivot_index], side, False):
+                    break
+                updateNeeded = True
+                rightHullPivot_Index = potentialRightHullPivot_index
+                steps += 1
+
+        if METRICS.enabled:
+            METRICS.count('hull.tangent_steps', steps)
         return leftHullPivot_Index, rightHullPivot_Index
 
-
-    # Given the leftHull array of points, iterates until it finds the one with the highest x-value
+    # True if moving the tangent left -> right onto candidate makes it a better tangent: candidate is strictly
+    # above the line (below for the lower tangent), or on the line but further out than the pivot it would replace
+    def isOutsideTangent(self, left, right, candidate, side, movingLeft):
+        turn = self.orientation(left, right, candidate)
+        if turn != 0:
+            return turn * side > 0
+
+        # collinear - only worth moving if the current pivot sits between candidate and the other end
+        pivot, other = (left, right) if movingLeft else (right, left)
+        xs = self.xs
+        ys = self.ys
+        return ((xs[candidate] - xs[pivot]) * (xs[other] - xs[pivot]) +
+                (ys[candidate] - ys[pivot]) * (ys[other] - ys[pivot])) < 0
+
+
+    # Andrew's monotone chain over sortedIndices (indices into self.xs/self.ys, sorted by x then y, no duplicates).
+    # Builds the upper chain left to right and the lower chain right to left, popping anything that isn't a
+    # clockwise turn, and returns the hull CW from the leftmost point like makeConvexRange
+    def monotoneChain( self, sortedIndices ):
+        orientation = self.orientation
+        upper = []
+        for i in sortedIndices:
+            while len(upper) >= 2 and orientation(upper[-2], upper[-1], i) >= 0:
+                upper.pop()
+            upper.append(i)
+        lower = []
+        for i in reversed(sortedIndices):
+            while len(lower) >= 2 and orientation(lower[-2], lower[-1], i) >= 0:
+                lower.pop()
+            lower.append(i)
+        return upper + lower[1:-1]
+
+    # The hull of some of the points (indices into self.xs/self.ys, any order), CW from the leftmost point
+    def hullOf( self, indices ):
+        xs = self.xs
+        ys = self.ys
+        return self.monotoneChain(sorted(indices, key=lambda i: (xs[i], ys[i])))
+
+    # QuickHull: split the points by the line through the leftmost and rightmost points, then keep splitting
+    # each side at the point furthest out, dropping everything in the triangles in between.
+    # O(n log h) on typical inputs (O(nh) worst case). The corners it finds are tidied up with an exact monotone
+    # chain at the end, which is only O(h log h), so a furthest point picked by rounding can't cost correctness.
+    def quickHull( self ):
+        n = len(self.xs)
+        if n <= 2:
+            return self.hullOf(range(n))
+        xs = self.xs
+        ys = self.ys
+        left = min(range(n), key=lambda i: (xs[i], ys[i]))
+        right = max(range(n), key=lambda i: (xs[i], ys[i]))
+
+        # Walk the hull CW: over the top from left to right, then along the bottom back. Each stack entry is
+        # either a corner to output or an edge (a, b, the points strictly outside it) still to be split.
+        corners = []
+        todo = [(right, left, self.pointsLeftOf(right, left, range(n))), right,
+                (left, right, self.pointsLeftOf(left, right, range(n))), left]
+        while todo:
+            item = todo.pop()
+            if not isinstance(item, tuple):
+                corners.append(item)
+                continue
+            a, b, (outside, furthest) = item
+            if outside:
+                todo.append((furthest, b, self.pointsLeftOf(furthest, b, outside)))
+                todo.append(furthest)
+                todo.append((a, furthest, self.pointsLeftOf(a, furthest, outside)))
+        return self.hullOf(corners)
+
+    # Returns (the points of candidates strictly left of a -> b, the one of them furthest from the line).
+    # The same test as orientation, inlined, with the exact fallback only for points too close to call.
+    def pointsLeftOf( self, a, b, candidates ):
+        xs = self.xs
+        ys = self.ys
+        ax = xs[a]
+        ay = ys[a]
+        dx = xs[b] - ax
+        dy = ys[b] - ay
+        left = []
+        furthest = None
+        furthestDet = 0.0
+        for i in candidates:
+            detLeft = dx * (ys[i] - ay)
+            detRight = dy * (xs[i] - ax)
+            det = detLeft - detRight
+            bound = ORIENTATION_ERROR_BOUND * (abs(detLeft) + abs(detRight))
+            if det <= bound and (-det > bound or self.orientation(a, b, i) <= 0):
+                continue
+            left.append(i)
+            if furthest is None or det > furthestDet:
+                furthest = i
+                furthestDet = det
+        return left, furthest
+
+    # Chan's algorithm: guess h <= m, hull groups of m points each in O(n log m), then gift-wrap around the
+    # groups - each wrapping step finds the best point of every group in O(log m) by binary search on its hull.
+    # If m steps don't get back to the start the guess was too small, so m is squared and it starts over.
+    # O(n log h) overall.
+    def chanHull( self ):
+        n = len(self.xs)
+        if n <= 2:
+            return self.hullOf(range(n))
+        m = 4
+        while True:
+            hull = self.wrapGroups(min(m, n))
+            if hull is not None:
+                return hull
+            m *= m
+
+    # One round of Chan's algorithm with groups of m points. Returns None if the hull has more than m corners.
+    def wrapGroups( self, m ):
+        xs = self.xs
+        ys = self.ys
+        orientation = self.orientation
+        groups = [self.hullOf(range(lo, min(lo + m, len(xs)))) for lo in range(0, len(xs), m)]
+
+        # The leftmost point overall is the leftmost (first) point of its group's hull
+        start = min(range(len(groups)), key=lambda g: (xs[groups[g][0]], ys[groups[g][0]]))
+        hull = [groups[start][0]]
+        current = (start, 0)
+        for step in range(m):
+            p = groups[current[0]][current[1]]
+
+            # The next corner clockwise: the candidate with no other candidate to its left (seen from p),
+            # taking the further one when two are in line with p
+            best = None
+            for g, group in enumerate(groups):
+                if g == current[0]:
+                    if len(group) == 1:
+                        continue
+                    t = (current[1] + 1) % len(group)  # p is a corner of its own group - next one round
+                else:
+                    t = self.tangentIndex(group, p)
+                if best is not None:
+                    q = groups[best[0]][best[1]]
+                    turn = orientation(p, q, group[t])
+                    if turn < 0 or (turn == 0 and self.distanceSquared(p, group[t]) <= self.distanceSquared(p, q)):
+                        continue
+                best = (g, t)
+
+            if best is None or groups[best[0]][best[1]] == hull[0]:
+                # a point in line with the edge it's on can sneak in when a group's tangent ties - drop those
+                return self.hullOf(hull)
+            hull.append(groups[best[0]][best[1]])
+            current = best
+        return None
+
+    # Given a group's hull (CW, no three corners in line) and a point p outside it, returns the position of the
+    # corner the gift wrap goes to from p: the one with the whole group right of (or on) p -> it.
+    # Edge i is "facing" p when p is left of it (orientation(p, hull[i], hull[i+1]) > 0). The facing edges are
+    # one unbroken run, and the answer is the corner where that run ends, which a binary search finds - the
+    # orientation of each corner against p -> hull[0] tells which side of the run it is on.
+    def tangentIndex( self, group, p ):
+        m = len(group)
+        orientation = self.orientation
+        if m <= 3:
+            return self.tangentIndexLinear(group, p)
+
+        def facing(i):
+            return orientation(p, group[i], group[(i + 1) % m]) > 0
+
+        # if edge 0 faces p the run starts at 0, otherwise it's somewhere after the edges that don't
+        startsFacing = facing(0)
+        lo = 1
+        hi = m
+        while lo < hi:
+            mid = (lo + hi) // 2
+            turn = orientation(p, group[0], group[mid])
+            if startsFacing:
+                pastRun = not (facing(mid) and turn > 0)
+            else:
+                pastRun = not facing(mid) and turn > 0
+            if pastRun:
+                hi = mid
+            else:
+                lo = mid + 1
+        t = lo % m
+
+        # near-degenerate groups can fool the search - check the answer, and scan the group if it's wrong
+        if not facing(t - 1) or facing(t):
+            return self.tangentIndexLinear(group, p)
+        if orientation(p, group[t], group[(t + 1) % m]) == 0:
+            t = (t + 1) % m  # the next corner is in line with p and further out
+        return t
+
+    def tangentIndexLinear( self, group, p ):
+        best = 0
+        for t in range(1, len(group)):
+            turn = self.orientation(p, group[best], group[t])
+            if turn > 0 or (turn == 0 and self.distanceSquared(p, group[t]) > self.distanceSquared(p, group[best])):
+                best = t
+        return best
+
+    def distanceSquared( self, a, b ):
+        return (self.xs[a] - self.xs[b]) ** 2 + (self.ys[a] - self.ys[b]) ** 2
+
+    # Checks an algorithm against the divide and conquer solver on random, gridded (lots of points in line and
+    # duplicates) and all-on-the-hull inputs. Returns true if every hull matches exactly.
+    def checkAlgorithm( self, name, trials=200 ):
+        rng = random.Random(312)
+        reference = ConvexHullSolver(algorithm='divide')
+        candidate = ConvexHullSolver(algorithm=name)
+        cases = [[(0.0, 0.0)], [(1.0, 1.0), (1.0, 1.0)], [(0.0, 0.0), (1.0, 1.0), (2.0, 2.0), (3.0, 3.0)]]
+        for i in range(trials):
+            n = rng.randint(1, 300)
+            kind = i % 3
+            if kind == 0:
+                cases.append([(rng.uniform(-1, 1), rng.uniform(-1, 1)) for j in range(n)])
+            elif kind == 1:
+                cases.append([(float(rng.randint(-4, 4)), float(rng.randint(-4, 4))) for j in range(n)])
+            else:
+                angles = [rng.uniform(0, math.tau) for j in range(n)]
+                cases.append([(math.cos(a), math.sin(a)) for a in angles])
+        return all(candidate.convexHullIndices(case) == reference.convexHullIndices(case) for case in cases)
+
+    # Switches the algorithm, checking it against the divide and conquer solver first unless check is False
+    def setAlgorithm( self, name, check=True ):
+        if name not in HULL_ALGORITHMS:
+            raise ValueError('Unknown hull algorithm: {}'.format(name))
+        if check and not self.checkAlgorithm(name):
+            raise ValueError('Hull algorithm {} disagrees with the divide and conquer solver'.format(name))
+        self.algorithm = name
+
+
+    # Given a hull, returns the position of its rightmost point (last in sorted order)
     def findRightmostPoint(self, leftHull):
-        assert( type(leftHull) == list and type(leftHull[0]) == QPointF )
-
-        for i in range(len(leftHull)):
-            if (i+1) >= len(leftHull):
-                # we can assume the current point is the rightmost
-                return i
-
-            if leftHull[i+1].x() < leftHull[i].x():
-                # the points are no longer increasing on the x-axis, so take the current point as the rightmost one
-                return i
-
-    # Given two QPointFs, returns the slope between them
-    def findSlope(self, point1, point2):
-        assert (type(point1) == QPointF and type(point2) == QPointF)
-
-        rise = point2.y() - point1.y()
-        run = point2.x() - point1.x()
-        return rise / run
\ No newline at end of file
+        return max(range(len(leftHull)), key=leftHull.__getitem__)
+
+    # Returns > 0 if c is to the left of the line a -> b (counterclockwise turn), < 0 if it's to the right,
+    # and 0 if the three points are collinear. Exact: when the floating point answer is too close to call
+    # it's redone with Fractions.
+    def orientation(self, a, b, c):
+        xs = self.xs
+        ys = self.ys
+        detLeft = (xs[a] - xs[c]) * (ys[b] - ys[c])
+        detRight = (ys[a] - ys[c]) * (xs[b] - xs[c])
+        det = detLeft - detRight
+        bound = ORIENTATION_ERROR_BOUND * (abs(detLeft) + abs(detRight))
+        if det > bound or -det > bound:
+            return det
+
+        ax, ay, bx, by, cx, cy = (Fraction(v) for v in (xs[a], ys[a], xs[b], ys[b], xs[c], ys[c]))
+        return (ax - cx) * (by - cy) - (ay - cy) * (bx - cx)
+
+
+
+# Process pool worker for parallelHull: sorts the slab's points (indices into the shared coordinates)
+# and builds their hull. Returns (the slab in sorted order; the hull as positions in that order)
+def _slabHull(shmName, n, slab):
+    shm = SharedMemory(name=shmName)
+    try:
+        coords = shm.buf.cast('d')
+        xs = coords[:n]
+        ys = coords[n:2 * n]
+        slabPoints = [(xs[i], ys[i]) for i in slab]
+        xs.release()
+        ys.release()
+        coords.release()
+    finally:
+        shm.close()
+
+    solver = ConvexHullSolver()
+    order = solver.loadSortedPoints(slabPoints)
+    return [slab[i] for i in order], solver.makeConvexRange(0, len(order))
+
+
+
+# Keeps the convex hull of a stream of points up to date one batch at a time. Only the current hull's
+# corners are kept between batches - every other point is inside the hull for good, so it can't come back.
+#
+#   hull = IncrementalHull()
+#   for batch in feed:
+#       corners = hull.addPoints(batch)     # [(x, y), ...] clockwise from the leftmost point
+#
+# Batches can be in any form ConvexHullSolver.convexHullIndices takes
+class IncrementalHull:
+    def __init__( self, workers=1 ):
+        self.solver = ConvexHullSolver(workers=workers)
+        # corners of the current hull, clockwise from the leftmost one
+        self.hullXs = []
+        self.hullYs = []
+        self.pointsSeen = 0
+        self.pointsDiscarded = 0  # batch points the filters threw away before the divide and conquer
+
+    def getHull( self ):
+        return list(zip(self.hullXs, self.hullYs))
+
+    # Adds a batch of points and returns the updated hull.
+    # Most of a batch never reaches the divide and conquer: points strictly inside the Akl-Toussaint octagon
+    # (the extreme points of the old hull plus the batch in 8 directions) or strictly inside the old hull are
+    # thrown away first, so each batch costs O(b log h) for the filtering plus a sort of whatever survives.
+    def addPoints( self, points ):
+        solver = self.solver
+        xs, ys = solver.loadCoordinates(points)
+        self.pointsSeen += len(xs)
+        if not xs:
+            return self.getHull()
+
+        # The solver's orientation test works on indices, so put the old corners and the batch side by side
+        h = len(self.hullXs)
+        solver.xs = self.hullXs + xs
+        solver.ys = self.hullYs + ys
+
+        octagon = self.aklToussaintPolygon()
+        survivors = self.outsidePolygon(octagon, range(h, h + len(xs)))
+        candidates = list(range(h)) + [i for i in survivors if not self.isInsideHull(h, i)]
+        self.pointsDiscarded += h + len(xs) - len(candidates)
+
+        allXs = solver.xs
+        allYs = solver.ys
+        hull = [candidates[i] for i in solver.convexHullIndices([(allXs[i], allYs[i]) for i in candidates])]
+        self.hullXs = [allXs[i] for i in hull]
+        self.hullYs = [allYs[i] for i in hull]
+        return self.getHull()
+
+    # The extreme points of solver.xs/ys in the 8 compass directions, clockwise from the west, with repeats
+    # dropped (the old hull's extremes are always among its corners, so the corners plus the batch is enough).
+    # Ties go to the point that comes first clockwise. Returns [] if rounding in x + y / y - x left the polygon
+    # not strictly convex, or it has fewer than 3 corners - either way the filter is just skipped for the batch.
+    def aklToussaintPolygon( self ):
+        solver = self.solver
+        xs = solver.xs
+        ys = solver.ys
+        sums = [x + y for x, y in zip(xs, ys)]
+        diffs = [y - x for x, y in zip(xs, ys)]
+
+        # (values, sign, tie-break values, sign) for W, NW, N, NE, E, SE, S, SW
+        directions = ((xs, -1, ys, 1), (diffs, 1, sums, -1), (ys, 1, xs, -1), (sums, 1, diffs, 1),
+                      (xs, 1, ys, -1), (diffs, -1, sums, 1), (ys, -1, xs, 1), (sums, -1, diffs, -1))
+        polygon = []
+        for values, sign, tieValues, tieSign in directions:
+            best = max(values) if sign > 0 else min(values)
+            extreme = values.index(best)
+            if values.count(best) > 1:
+                ties = [i for i in range(len(values)) if values[i] == best]
+                extreme = max(ties, key=lambda i: tieSign * tieValues[i])
+            if not polygon or (xs[extreme], ys[extreme]) != (xs[polygon[-1]], ys[polygon[-1]]):
+                polygon.append(extreme)
+        if len(polygon) > 1 and (xs[polygon[0]], ys[polygon[0]]) == (xs[polygon[-1]], ys[polygon[-1]]):
+            polygon.pop()
+
+        if len(polygon) < 3:
+            return []
+        for k in range(len(polygon)):
+            if solver.orientation(polygon[k - 2], polygon[k - 1], polygon[k]) >= 0:
+                return []
+        return polygon
+
+    # Returns the points of candidates that aren't clearly strictly inside the clockwise convex polygon.
+    # Plain floating point with a safety margin - a point too close to an edge to call is kept, and the
+    # exact tests further on sort it out.
+    def outsidePolygon( self, polygon, candidates ):
+        if len(polygon) < 3:
+            return list(candidates)
+        xs = self.solver.xs
+        ys = self.solver.ys
+        scale = max(max(abs(v) for v in xs), max(abs(v) for v in ys)) + 1.0
+
+        outside = set()
+        for k in range(len(polygon)):
+            a = polygon[k - 1]
+            b = polygon[k]
+            dx = xs[b] - xs[a]
+            dy = ys[b] - ys[a]
+            offset = dy * xs[a] - dx * ys[a]
+            margin = 2.0 ** -40 * (abs(dx) + abs(dy)) * scale
+            # (b - a) x (p - a) < 0 means p is strictly right of a -> b, i.e. inside this edge
+            outside.update([i for i in candidates if dx * ys[i] - dy * xs[i] + offset > -margin])
+        return sorted(outside)
+
+    # True if point p is strictly inside the old hull, which is indices 0..h-1 - O(log h).
+    # Binary searches the fan of triangles out of corner 0 for the one p is in, then checks the hull edge.
+    def isInsideHull( self, h, p ):
+        if h < 3:
+            return False
+        orientation = self.solver.orientation
+        if orientation(0, 1, p) >= 0 or orientation(0, h - 1, p) <= 0:
+            return False
+
+        # p is right of 0 -> 1 and left of 0 -> h-1: find the last corner i with p strictly right of 0 -> i
+        lo = 1
+        hi = h - 1
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if orientation(0, mid, p) < 0:
+                lo = mid
+            else:
+                hi = mid
+        return orientation(lo, lo + 1, p) < 0
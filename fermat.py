@@ -1,77 +1,371 @@
+import math
+import os
 import random
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import compress
+from instrumentation import METRICS, captured
+
+# Trial division by every prime below this weeds out most composites before any exponentiation
+TRIAL_DIVISION_LIMIT = 256
+SMALL_PRIMES = [p for p in range(2, TRIAL_DIVISION_LIMIT) if all(p % d != 0 for d in range(2, int(p ** 0.5) + 1))]
+SMALL_PRIME_SET = frozenset(SMALL_PRIMES)
+SMALL_PRIMORIAL = math.prod(SMALL_PRIMES)  # one gcd against this does all the trial divisions at once
+
+# Defaults for primes_in_range
+SIEVE_BOUND = 1 << 20       # largest prime the segmented sieve crosses off multiples of
+SEGMENT_SIZE = 1 << 20      # how many numbers each sieve segment covers
+
+# mod_exp backends: 'builtin' is Python's pow (C code, fastest under CPython), 'binary' is plain
+# square-and-multiply, 'window' is sliding-window, and 'montgomery' is sliding-window with Montgomery
+# reduction (odd moduli only - even ones fall back to 'window')
+MOD_EXP_BACKENDS = ('builtin', 'binary', 'window', 'montgomery')
+_mod_exp_backend = 'builtin'
+
+# Miller-Rabin witness sets that give an exact answer for every N below the bound (Jaeschke / Jiang & Deng).
+# Checked in order, so small N only pay for the few witnesses they need.
+DETERMINISTIC_WITNESSES = [
+    (2047, (2,)),
+    (1373653, (2, 3)),
+    (25326001, (2, 3, 5)),
+    (3215031751, (2, 3, 5, 7)),
+    (2152302898747, (2, 3, 5, 7, 11)),
+    (3474749660383, (2, 3, 5, 7, 11, 13)),
+    (341550071728321, (2, 3, 5, 7, 11, 13, 17)),
+    (3825123056546413051, (2, 3, 5, 7, 11, 13, 17, 19, 23)),
+    (318665857834031151167461, (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37)),  # covers all 64-bit N
+]
+
 
 # Should return one of two values: 'prime' or 'composite'
 def prime_test(N, k):
+    return 'prime' if is_probable_prime(N, k) else 'composite'
+
+
+# Runs prime_test on every N in Ns and returns the answers in the same order
+@captured('prime_test_many')
+def prime_test_many(Ns, k):
+    small_primes = SMALL_PRIME_SET
+    primorial = SMALL_PRIMORIAL
+    gcd = math.gcd
+    results = []
+    append = results.append
+    for N in Ns:
+        if N < TRIAL_DIVISION_LIMIT:
+            append('prime' if N in small_primes else 'composite')
+        elif gcd(N, primorial) != 1:
+            append('composite')  # has a small factor, no exponentiation needed
+        else:
+            append('prime' if _passes_miller_rabin(N, k) else 'composite')
+    return results
+
+
+# Generates every prime in [lo, hi) in increasing order.
+# Each segment is sieved with the primes up to sieve_bound, and only the survivors get a Miller-Rabin test
+# (none is needed once sieve_bound reaches sqrt(hi)). With workers > 1 the segments are sieved in a process
+# pool, with only a couple of segments per worker in flight so memory stays flat however big the range is.
+def primes_in_range(lo, hi, k, sieve_bound=SIEVE_BOUND, segment_size=SEGMENT_SIZE, workers=1):
+    lo = max(lo, 0)
+    if hi <= lo:
+        return
+
+    root = math.isqrt(hi - 1)
+    # the sieve has to at least cover the trial division primes Miller-Rabin counts on
+    bound = max(min(sieve_bound, root), TRIAL_DIVISION_LIMIT)
+    exact = bound >= root
+    base_primes = simple_sieve(bound)
+    segments = ((start, min(start + segment_size, hi)) for start in range(lo, hi, segment_size))
+
+    if workers is not None and workers <= 1:
+        for start, end in segments:
+            yield from sieve_segment(start, end, base_primes, k, exact)
+        return
+
+    workers = workers or os.cpu_count() or 1
+    in_flight = 2 * workers
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_sieve_worker,
+                             initargs=(base_primes, k, exact, _mod_exp_backend)) as pool:
+        pending = deque()
+        for start, end in segments:
+            pending.append(pool.submit(_sieve_worker_segment, start, end))
+            if len(pending) >= in_flight:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+# Returns the list of primes <= n (plain sieve of Eratosthenes)
+def simple_sieve(n):
+    if n < 2:
+        return []
+    is_prime = bytearray([1]) * (n + 1)
+    is_prime[0] = is_prime[1] = 0
+    for p in range(2, math.isqrt(n) + 1):
+        if is_prime[p]:
+            is_prime[p * p::p] = bytes(len(range(p * p, n + 1, p)))
+    return list(compress(range(n + 1), is_prime))
 
-    # if k > n, just make k = (n-2) to avoid picking a ton of duplicates or useless numbers (0, 1)
-    if k > N:
-        k = (N - 2)
 
-    used_a_values = []
-    for i in range(0, k):  # loop for as many a-values as they told us to do
+# Returns the primes in [lo, hi): crosses off multiples of base_primes (sorted), then Miller-Rabin
+# tests whatever's left unless the base primes already reach sqrt(hi)
+def sieve_segment(lo, hi, base_primes, k, exact):
+    size = hi - lo
+    is_candidate = bytearray([1]) * size
+    for p in base_primes:
+        if p * p >= hi:
+            break
+        start = max(p * p, -(-lo // p) * p) - lo
+        is_candidate[start::p] = bytes(len(range(start, size, p)))
+    for n in range(lo, min(2, hi)):
+        is_candidate[n - lo] = 0  # 0 and 1 aren't prime
 
-        a = random.randint(1, N-1)  # pick a random value in the Z-set of N (aka P)
-        while a in used_a_values:
-            a = random.randint(1, N-1)
+    survivors = compress(range(lo, hi), is_candidate)
+    if exact:
+        return list(survivors)
+    return [n for n in survivors if _passes_miller_rabin(n, k)]
 
-        used_a_values.append(a)
 
-        result = mod_exp(a, N-1, N)
+# Process pool workers get the base primes once instead of with every segment
+_sieve_state = None
 
-        #check if it's NOT a 1 - if so, this number N can't be prime
-        if result != 1:
-            return 'composite'
-        elif carmichael_test(N, a): # if carmichael_test says true, then the number was a "fake prime"
-            return 'composite'
+def _init_sieve_worker(base_primes, k, exact, backend):
+    global _sieve_state, _mod_exp_backend
+    _sieve_state = (base_primes, k, exact)
+    _mod_exp_backend = backend
 
-    # finished all the random a-values, so it must be prime
-    return 'prime'
+def _sieve_worker_segment(lo, hi):
+    base_primes, k, exact = _sieve_state
+    return sieve_segment(lo, hi, base_primes, k, exact)
 
 
-# Called by prime_test for every a-value (passed in by K)
+# True if N is prime (exact for N < 2^64, wrong with probability at most 4^-k above that)
+def is_probable_prime(N, k):
+    if N < TRIAL_DIVISION_LIMIT:
+        return N in SMALL_PRIME_SET
+    if math.gcd(N, SMALL_PRIMORIAL) != 1:
+        return False
+    return _passes_miller_rabin(N, k)
+
+
+# Miller-Rabin for an N that's already made it through trial division
+def _passes_miller_rabin(N, k):
+    # anything this small with no factor below the trial division limit has to be prime
+    if N < TRIAL_DIVISION_LIMIT * TRIAL_DIVISION_LIMIT:
+        return True
+
+    witnesses = deterministic_witnesses(N)
+    if witnesses is None:
+        witnesses = random_witnesses(N, k)
+
+    context = ModExpContext(N)  # shared by every witness
+    for a in witnesses:
+        if carmichael_test(N, a, context):  # a proves N is composite
+            return False
+    return True
+
+
+# Returns the witness set that makes Miller-Rabin exact for N, or None if N is too big for one
+def deterministic_witnesses(N):
+    for bound, witnesses in DETERMINISTIC_WITNESSES:
+        if N < bound:
+            return witnesses
+    return None
+
+
+# Picks k different random witnesses from [2, N-2]
+def random_witnesses(N, k):
+    # if k is bigger than the number of candidates, just use all of them
+    k = min(k, N - 3)
+    used_a_values = set()
+    while len(used_a_values) < k:
+        used_a_values.add(random.randint(2, N - 2))
+    return used_a_values
+
+
+# Computes x^y mod N with the selected backend
 def mod_exp(x, y, N):
-    if y == 0:
-        return 1        # BASE CASE
-    z = mod_exp(x, y//2, N)
-    if y % 2 == 0:      # if y is even
-        return (z * z) % N
-    else:               # if y is odd
-        return x * (z * z) % N
-
-
-# Returns true if the number is probably a carmichael number, false otherwise (so N is prime)
-def carmichael_test(N, a):
-
-    # Calculate t and u:
-    u = N-1
-    t = 0   # counter variable
-    while u % 2 != 1:   # while u is even, keep dividing it in half and keep track of how many times we did it
-        u = u / 2
-        t += 1
-
-    # Repeatedly square the u-value, and put (a, u, and N) through the mod_exp function until you get a 1
-    prev_result = N-1  # setting this to N-1 allows for the case when mod_exp returns 1 first time
-    for i in range(0, t+1):  # loop this t number of times
-        result = mod_exp(a, u, N)  # square the u value and run it through mod_exp again
-
-        # If we got a 1, look at the previous value to see if it equals N-1.
-        # If so, then N is prime. If not, then N is composite.
-        if result == 1:
-            if prev_result == (N - 1):
-                # N is prime, so N cannot be a carmichael number
-                return False
+    if _mod_exp_backend == 'builtin':
+        if METRICS.enabled:
+            METRICS.count('fermat.modmults', square_and_multiply_count(y))
+        return pow(x, y, N)
+    return ModExpContext(N).exp(x, y)
+
+
+# Multiplications (squarings included) square-and-multiply needs for an exponent of y. pow() does its own
+# multiplications in C where they can't be counted, so the 'builtin' backend reports this instead.
+def square_and_multiply_count(y):
+    return max(y.bit_length() + bin(y).count('1') - 2, 0)
+
+
+# Switches the backend mod_exp (and everything built on it) uses. The backend is checked
+# against pow(x, y, N) first unless check is False.
+def set_mod_exp_backend(name, check=True):
+    global _mod_exp_backend
+    if name not in MOD_EXP_BACKENDS:
+        raise ValueError('Unknown mod_exp backend: {}'.format(name))
+    if check and not check_mod_exp_backend(name):
+        raise ValueError('mod_exp backend {} disagrees with pow()'.format(name))
+    _mod_exp_backend = name
+
+
+def get_mod_exp_backend():
+    return _mod_exp_backend
+
+
+# Returns true if the backend matches pow(x, y, N) on a batch of random (and edge case) inputs
+def check_mod_exp_backend(name, trials=200, bits=256):
+    rng = random.Random(312)
+    cases = [(0, 0, 7), (5, 0, 7), (0, 5, 7), (3, 1, 2), (7, 13, 1), (2, 10, 1024)]
+    for i in range(trials):
+        N = rng.getrandbits(rng.randint(2, bits)) | 2
+        cases.append((rng.getrandbits(bits + 8), rng.getrandbits(rng.randint(1, bits)), N))
+    return all(ModExpContext(N, name).exp(x, y) == pow(x, y, N) for x, y, N in cases)
+
+
+# Everything modular exponentiation needs for one modulus N, worked out once and reused for every witness.
+# Values handed to power/mul/square live in the backend's domain (Montgomery form for 'montgomery',
+# plain residues otherwise), so results can be compared against one/minus_one without converting back.
+class ModExpContext:
+    def __init__(self, N, backend=None):
+        self.N = N
+        self.backend = backend or _mod_exp_backend
+        if METRICS.enabled:
+            self.mul = self.counted_mul  # shadows mul for this context only, so uncounted ones pay nothing
+        if self.backend == 'montgomery' and N % 2 == 0:
+            self.backend = 'window'  # Montgomery reduction needs N coprime to R = 2^bits
+
+        if self.backend == 'montgomery':
+            self.bits = N.bit_length()
+            self.mask = (1 << self.bits) - 1
+            self.n_prime = (-pow(N, -1, 1 << self.bits)) & self.mask  # N * n_prime = -1 mod R
+            self.r2 = (1 << (2 * self.bits)) % N                      # R^2 mod N, for converting into the domain
+
+        self.one = self.to_domain(1)
+        self.minus_one = self.to_domain(N - 1)
+
+        # N-1 = u * 2^t with u odd
+        u = N - 1
+        t = 0
+        while u > 0 and u & 1 == 0:
+            u >>= 1
+            t += 1
+        self.u = u
+        self.t = t
+
+    # Montgomery reduction: returns T / R mod N for T < N*R
+    def redc(self, T):
+        m = ((T & self.mask) * self.n_prime) & self.mask
+        T = (T + m * self.N) >> self.bits
+        return T - self.N if T >= self.N else T
+
+    def to_domain(self, x):
+        if self.backend == 'montgomery':
+            return self.redc((x % self.N) * self.r2)
+        return x % self.N
+
+    def from_domain(self, x):
+        if self.backend == 'montgomery':
+            return self.redc(x)
+        return x
+
+    def mul(self, a, b):
+        if self.backend == 'montgomery':
+            return self.redc(a * b)
+        return (a * b) % self.N
+
+    def counted_mul(self, a, b):
+        METRICS.counters['fermat.modmults'] += 1
+        return ModExpContext.mul(self, a, b)
+
+    def square(self, a):
+        return self.mul(a, a)
+
+    # x^y mod N for a plain x, returned as a plain residue
+    def exp(self, x, y):
+        return self.from_domain(self.power(self.to_domain(x), y))
+
+    # a^y for an a that's already in the domain
+    def power(self, a, y):
+        if self.backend == 'builtin':
+            if METRICS.enabled:
+                METRICS.count('fermat.modmults', square_and_multiply_count(y))
+            return pow(a, y, self.N)
+        if self.backend == 'binary':
+            return self.binary_power(a, y)
+        return self.window_power(a, y)
+
+    # Square-and-multiply, one bit of y at a time from the bottom up
+    def binary_power(self, a, y):
+        result = self.one
+        while y > 0:
+            if y & 1:       # if this bit of y is set
+                result = self.mul(result, a)
+            a = self.square(a)
+            y >>= 1
+        return result
+
+    # Sliding window: scans y from the top, squaring for every bit and multiplying in a
+    # precomputed odd power of a once per window of up to w bits
+    def window_power(self, a, y):
+        if y == 0:
+            return self.one
+        bit = y.bit_length() - 1
+        w = 1 if bit < 8 else 3 if bit < 64 else 4 if bit < 256 else 5 if bit < 1024 else 6
+
+        # odd_powers[i] = a^(2i+1)
+        odd_powers = [a]
+        a_squared = self.square(a)
+        for i in range((1 << (w - 1)) - 1):
+            odd_powers.append(self.mul(odd_powers[-1], a_squared))
+
+        result = None
+        while bit >= 0:
+            if not (y >> bit) & 1:
+                result = self.square(result)
+                bit -= 1
+                continue
+
+            # longest window of at most w bits that starts at this bit and ends on a set bit
+            low = max(bit - w + 1, 0)
+            while not (y >> low) & 1:
+                low += 1
+            window = (y >> low) & ((1 << (bit - low + 1)) - 1)
+
+            if result is None:
+                result = odd_powers[window >> 1]
             else:
-                # N is composite, so N is probably a carmichael number
-                return True
+                for i in range(bit - low + 1):
+                    result = self.square(result)
+                result = self.mul(result, odd_powers[window >> 1])
+            bit = low - 1
+        return result
+
+
+# Returns true if a proves N is composite (so N could only pass a Fermat test as a carmichael number),
+# false if N is probably prime. Pass the ModExpContext for N when testing several a's against the same N.
+def carmichael_test(N, a, context=None):
+    if context is None:
+        context = ModExpContext(N)
+
+    # One exponentiation for a^u (N-1 = u * 2^t), then each later a^(u*2^i) is just the square of the one before
+    result = context.power(context.to_domain(a), context.u)
+    if result == context.one or result == context.minus_one:
+        return False
 
-        prev_result = result
-        u = u*2
+    for i in range(context.t - 1):
+        result = context.square(result)
+        if result == context.minus_one:
+            return False
+        if result == context.one:
+            # 1 with no N-1 right before it is a nontrivial square root of 1, so N is composite
+            return True
 
-    # N is not prime, so N is probably a carmichael number
+    # never hit N-1, so a^(N-1) isn't 1 (or got there the wrong way) and N is composite
     return True
 
 
 
-# Calculates the probability that this number, which we're reporting is prime, is actually a composite.
+# Calculates the probability that this number, which we're reporting is prime, is actually prime
+# (each Miller-Rabin round lets a composite through at most 1/4 of the time)
 def probability(k):
-    return 1.0 - (1.0/(2.0 ** k))
\ No newline at end of file
+    return 1.0 - (1.0/(4.0 ** k))
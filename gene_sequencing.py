@@ -8,7 +8,328 @@ if PYQT_VER == 'PYQT5':
 else:
     raise Exception('Unsupported Version of PyQt: {}'.format(PYQT_VER))
 
+import hashlib
+import mmap
+import os
+import sqlite3
 import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from instrumentation import METRICS, captured
+from memory_cache import MemoryLRU
+
+# Scoring constants
+MATCH = -3
+MISMATCH = 1
+INDEL = 5
+
+# Alignment modes accepted by align_all/calcAlignCost
+MODE_FULL = 'full'              # full matrix DP with a back pointer for every cell
+MODE_COST = 'cost'              # cost only - keeps two rows (or the band) in memory
+MODE_HIRSCHBERG = 'hirschberg'  # divide and conquer, alignment strings in linear memory
+
+# What part of the two sequences a Scoring lines up
+ALIGN_GLOBAL = 'global'            # all of both, end to end
+ALIGN_LOCAL = 'local'              # the lowest cost pair of substrings (Smith-Waterman), which can be empty
+ALIGN_SEMIGLOBAL = 'semi-global'   # all of both, but gaps at either end of either sequence are free
+ALIGNMENTS = (ALIGN_GLOBAL, ALIGN_LOCAL, ALIGN_SEMIGLOBAL)
+# Trace bits per cell for scoredDP: the low two bits say where the cell's best cost came from (DIAG, or
+# LEFT/UP for a gap ending there, or TRACE_STOP where a local alignment starts), and the other two whether
+# the LEFT/UP gap ending there was opened at this cell or extended from the one before
+TRACE_STOP = 3
+TRACE_LEFT_OPEN = 4
+TRACE_UP_OPEN = 8
+# scoredDP runs on int32 unless (length1 + length2) * the biggest cost could get near this, then on int64
+SCORED_INT32_LIMIT = 1 << 28
+
+# Default band: how many cells on each side of the diagonal a banded alignment looks at
+BAND_WIDTH = 3
+# Bands at least this wide are filled with NumPy row operations, narrower ones with a plain loop
+# (for a handful of cells the per-call overhead of NumPy costs more than it saves)
+BAND_VECTOR_MIN_WIDTH = 64
+# Stand-in for cells outside the band - never wins a min and never overflows an int64
+BAND_INF = 1 << 60
+# Hirschberg subproblems with at most this many cells are solved with a plain DP
+HIRSCHBERG_BASE_CELLS = 4096
+# How many alignment columns the GUI shows
+DISPLAY_LEN = 100
+
+# Costs for the scored alignments - lower is better, like MATCH/MISMATCH/INDEL. Letters are scored with
+# matrix[i][j] for the i-th and j-th letters of alphabet when there is a matrix (a letter that isn't in alphabet
+# costs mismatch against anything), and with match/mismatch when there isn't. A gap of length L costs
+# gapOpen + L * gapExtend, so gapOpen = 0 is the plain linear INDEL cost. alignment is one of ALIGNMENTS.
+class Scoring:
+    def __init__(self, match=MATCH, mismatch=MISMATCH, gapOpen=0, gapExtend=INDEL, alignment=ALIGN_GLOBAL,
+                 matrix=None, alphabet=None):
+        if alignment not in ALIGNMENTS:
+            raise ValueError('Unknown alignment: {}'.format(alignment))
+        if gapOpen < 0 or gapExtend < 0:
+            raise ValueError('Gap costs must be non-negative')
+        if (matrix is None) != (alphabet is None):
+            raise ValueError('A substitution matrix needs its alphabet and the other way round')
+        self.match = int(match)
+        self.mismatch = int(mismatch)
+        self.gapOpen = int(gapOpen)
+        self.gapExtend = int(gapExtend)
+        self.alignment = alignment
+        self.alphabet = alphabet
+        self.matrix = None
+        self.letters = None
+        if matrix is not None:
+            matrix = np.array(matrix, dtype=np.int64)
+            if matrix.shape != (len(alphabet), len(alphabet)):
+                raise ValueError('The substitution matrix has to be {0} x {0} for its alphabet'.format(len(alphabet)))
+            # sorted by letter code so codes can be looked up with searchsorted, plus one row/column for
+            # letters that aren't in the alphabet
+            codes = np.array([ord(c) for c in alphabet], dtype=np.int64)
+            order = np.argsort(codes)
+            self.letters = codes[order]
+            self.matrix = np.full((len(alphabet) + 1, len(alphabet) + 1), self.mismatch, dtype=np.int64)
+            self.matrix[:-1, :-1] = matrix[order][:, order]
+
+    # Builds a Scoring from a similarity matrix (higher is better, like BLOSUM or PAM) by turning the scores
+    # into costs. The gap costs stay penalties: non-negative, and added to the cost.
+    @classmethod
+    def fromScores(cls, matrix, alphabet, gapOpen, gapExtend, alignment=ALIGN_GLOBAL):
+        return cls(gapOpen=gapOpen, gapExtend=gapExtend, alignment=alignment,
+                   matrix=-np.array(matrix, dtype=np.int64), alphabet=alphabet)
+
+    # True if this is exactly the MATCH/MISMATCH/INDEL global alignment the unscored kernels do
+    def isDefault(self):
+        return (self.matrix is None and self.match == MATCH and self.mismatch == MISMATCH and self.gapOpen == 0
+                and self.gapExtend == INDEL and self.alignment == ALIGN_GLOBAL)
+
+    # Everything that changes the answer, for AlignmentCache keys
+    def key(self):
+        matrixDigest = 'none'
+        if self.matrix is not None:
+            matrixDigest = hashlib.blake2b(self.letters.tobytes() + self.matrix.tobytes(), digest_size=8).hexdigest()
+        return '{},{},{},{},{},{}'.format(self.match, self.mismatch, self.gapOpen, self.gapExtend, self.alignment,
+                                          matrixDigest)
+
+    # Biggest cost any single step can add, for picking a dtype that can't overflow
+    def maxStepCost(self):
+        costs = [abs(self.match), abs(self.mismatch), self.gapOpen + self.gapExtend]
+        if self.matrix is not None:
+            costs.append(int(np.abs(self.matrix).max()))
+        return max(costs)
+
+    # Query profile: returns (profile, rows) where profile[r] is the cost of lining one letter up with every
+    # letter of codes2, and rows[x] is which profile row codes1[x] uses. Every row is worked out once per
+    # letter of the alphabet instead of once per row of the DP.
+    def queryProfile(self, codes1, codes2):
+        if self.matrix is None:
+            letters, rows = np.unique(codes1, return_inverse=True)
+            profile = np.where(letters[:, None] == codes2[None, :], self.match, self.mismatch)
+            return profile, rows
+        return self.matrix[:, self.letterIndex(codes2)], self.letterIndex(codes1)
+
+    # Index of every code in the alphabet (the extra last index for letters that aren't in it)
+    def letterIndex(self, codes):
+        codes = codes.astype(np.int64)
+        index = np.searchsorted(self.letters, codes)
+        index[index == len(self.letters)] = 0
+        index[self.letters[index] != codes] = len(self.letters)
+        return index
+
+
+# An op script (DIAG/LEFT/UP per alignment column) for a local alignment, which starts at
+# (start[0], start[1]) in the two sequences instead of at the beginning of both
+class LocalScript(bytearray):
+    def __init__(self, ops, start):
+        bytearray.__init__(self, ops)
+        self.start = start
+
+
+# Back pointers packed 2 bits per cell (LEFT/UP/DIAG), with every row starting on a fresh byte.
+# Full alignments store every column of a row. Banded ones (bandWidth = d) only store the 2d+1 cells
+# around the diagonal, where cell k of row x is column y = x - d + k.
+class PackedBackPtrs:
+    def __init__(self, rows, cols, bandWidth=None):
+        self.rows = rows
+        self.cols = cols
+        self.bandWidth = bandWidth
+        self.width = cols if bandWidth is None else 2 * bandWidth + 1
+        self.stride = (self.width + 3) // 4 # bytes per row
+        self.cells = np.zeros(rows * self.stride, dtype=np.uint8) # all LEFT (0) to start with
+        self.view = memoryview(self.cells) # plain ints per lookup, much cheaper than NumPy scalars
+
+    # The pointer stored for cell (x, y)
+    def get(self, x, y):
+        k = y if self.bandWidth is None else y - x + self.bandWidth
+        return (self.view[x * self.stride + (k >> 2)] >> ((k & 3) << 1)) & 3
+
+    # Packs a whole row of pointers (one uint8 per stored cell) into row x
+    def setRow(self, x, ptrRow):
+        padded = np.zeros(self.stride * 4, dtype=np.uint8)
+        padded[:self.width] = ptrRow
+        quads = padded.reshape(-1, 4)
+        self.cells[x * self.stride:(x + 1) * self.stride] = (quads[:, 0] | (quads[:, 1] << 2) |
+                                                             (quads[:, 2] << 4) | (quads[:, 3] << 6))
+
+
+# Read-only, memory-mapped view of a FASTA file. Building it only records where each record's
+# sequence starts and ends; store.sequence(i, limit) then hands back (the first limit letters of) record i
+# as a uint8 array, and store[i] all of it. Records written on a single line come straight out of the
+# mapping without a copy. Wrapped records have their line breaks stripped into a fresh array each time,
+# only as far into the record as the limit goes, and nothing is kept.
+# A store can be passed to align_all in place of a list of strings.
+class FastaStore:
+    def __init__(self, path):
+        self.path = path
+        self.names = []
+        self.spans = []       # (start, end) byte offsets of each record's sequence
+        self.lengths = []     # number of letters in each record
+        self.lineWidths = []  # bytes in the first line of each record (all of it for single-line ones)
+        self.file = open(path, 'rb')
+        if os.fstat(self.file.fileno()).st_size == 0:
+            self.file.close()
+            raise ValueError('{} is empty - there are no FASTA records in it'.format(path))
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.buildIndex()
+
+    # Scans the mapping for headers without reading the sequences into Python objects
+    def buildIndex(self):
+        data = self.data
+        size = len(data)
+        pos = data.find(b'>')
+        while pos != -1:
+            headerEnd = data.find(b'\n', pos)
+            if headerEnd == -1:
+                headerEnd = size
+            self.names.append(data[pos + 1:headerEnd].strip().decode('utf-8', 'replace'))
+
+            start = min(headerEnd + 1, size)
+            nextHeader = data.find(b'\n>', headerEnd)
+            # an empty record's header is followed straight away by the next one, whose '\n>' starts at headerEnd
+            end = max(nextHeader if nextHeader != -1 else size, start)
+            while end > start and data[end - 1] in b'\r\n \t':
+                end -= 1
+
+            raw = np.frombuffer(data, dtype=np.uint8, count=end - start, offset=start)
+            lineEnd = data.find(b'\n', start, end)
+            self.spans.append((start, end))
+            self.lengths.append(end - start - int(np.count_nonzero((raw == ord('\n')) | (raw == ord('\r')))))
+            self.lineWidths.append(end - start if lineEnd == -1 else lineEnd + 1 - start)
+            del raw
+            pos = nextHeader + 1 if nextHeader != -1 else -1
+
+    def __len__(self):
+        return len(self.spans)
+
+    def __getitem__(self, i):
+        return self.sequence(i)
+
+    # Record i's letters, or only the first limit of them
+    def sequence(self, i, limit=None):
+        start, end = self.spans[i]
+        length = self.lengths[i]
+        if limit is None or limit > length:
+            limit = length
+        if length == end - start:
+            return np.frombuffer(self.data, dtype=np.uint8, count=limit, offset=start)
+
+        # enough bytes for limit letters if every line is as wide as the first one (plus a CRLF per line),
+        # and twice as many again whenever the lines turn out to be shorter
+        rawLen = min(end - start, limit + 2 * (limit // max(1, self.lineWidths[i] - 2) + 1))
+        while True:
+            raw = np.frombuffer(self.data, dtype=np.uint8, count=rawLen, offset=start)
+            codes = raw[(raw != ord('\n')) & (raw != ord('\r'))]
+            if len(codes) >= limit or rawLen == end - start:
+                return codes[:limit].copy() if len(codes) > limit else codes
+            rawLen = min(end - start, 2 * rawLen)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    # Process pool workers re-open the file instead of getting the sequences pickled over
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    # Any arrays handed out by store[i] have to be dropped before the mapping can close
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+
+# Remembers finished pair alignments (cost plus the two alignment strings), keyed by the content of
+# the two sequences and every setting that changes the answer. Recently used results are kept in
+# memory up to maxBytes; if a path is given they're also written to a sqlite file that outlives the process.
+class AlignmentCache:
+    def __init__(self, maxBytes=64 * 1024 * 1024, path=None):
+        self.memory = MemoryLRU(maxBytes, self.resultSize) # key -> (cost, seqiAlignment, seqjAlignment)
+        self.hits = 0
+        self.diskHits = 0
+        self.misses = 0
+        self.db = None
+        if path is not None:
+            self.db = sqlite3.connect(path)
+            self.db.execute('CREATE TABLE IF NOT EXISTS alignments '
+                            '(key TEXT PRIMARY KEY, cost REAL, seqi TEXT, seqj TEXT)')
+
+    # Hash of one (already truncated) sequence - worked out once per sequence, not once per pair
+    def sequenceDigest(self, seq):
+        if isinstance(seq, str):
+            seq = seq.encode('utf-8')
+        return hashlib.blake2b(seq, digest_size=16).hexdigest()
+
+    def makeKey(self, digest1, digest2, banded, alignLen, mode, bandWidth, scoring=None):
+        if scoring is None or scoring.isDefault():
+            scoringKey = '{},{},{}'.format(MATCH, MISMATCH, INDEL)
+        else:
+            scoringKey = scoring.key()
+        return '{}:{}:{}:{}:{}:{}'.format(digest1, digest2, scoringKey,
+                                          bandWidth if banded else 'unbanded', mode, alignLen)
+
+    # Returns the cached (cost, seqiAlignment, seqjAlignment) for key, or None
+    def get(self, key):
+        result = self.memory.get(key)
+        if result is not None:
+            self.hits += 1
+            return result
+
+        if self.db is not None:
+            row = self.db.execute('SELECT cost, seqi, seqj FROM alignments WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                cost = row[0]
+                if cost != float('inf'):
+                    cost = int(cost)
+                result = (cost, row[1], row[2])
+                self.memory.put(key, result)
+                self.diskHits += 1
+                return result
+
+        self.misses += 1
+        return None
+
+    def put(self, key, result):
+        self.memory.put(key, result)
+        if self.db is not None:
+            self.db.execute('INSERT OR REPLACE INTO alignments VALUES (?, ?, ?, ?)', (key,) + tuple(result))
+
+    @staticmethod
+    def resultSize(key, result):
+        return len(key) + len(result[1]) + len(result[2])
+
+    # Writes any pending disk entries out
+    def flush(self):
+        if self.db is not None:
+            self.db.commit()
+
+    def close(self):
+        if self.db is not None:
+            self.db.commit()
+            self.db.close()
+            self.db = None
+
+    def stats(self):
+        return {'hits': self.hits, 'disk_hits': self.diskHits, 'misses': self.misses,
+                'entries': len(self.memory), 'bytes': self.memory.usedBytes}
+
 
 class GeneSequencing:
 
@@ -20,173 +341,739 @@ class GeneSequencing:
     global DIAG
     DIAG = 2
 
-    def __init__( self ):
-        pass
+    # cache is an optional AlignmentCache shared by every align_all call
+    def __init__( self, cache=None ):
+        self.cache = cache
 
     # Main method for calculating the sequence alignments
-    def align_all(self, sequences, banded, align_length):
+    # bandWidth is d, the number of cells on each side of the diagonal used when banded
+    # scoring is a Scoring (substitution matrix, affine gaps, local/semi-global) - None is MATCH/MISMATCH/INDEL
+    # workers > 1 sends the (i, j) pairs to a process pool, chunkSize is the number of pairs per task
+    # (by default chunks are sized by estimated cost so the big pairs don't all land in one task)
+    @captured('align_all')
+    def align_all(self, sequences, banded, align_length, mode=MODE_FULL, workers=1, chunkSize=None,
+                  bandWidth=BAND_WIDTH, scoring=None):
+        self.checkScoring(mode, scoring)
 
         # sequences is the list of strings - one for every row/col item (same on each side)
-        print(">ALIGNALL(): starting")
-
+        # (it can also be a FastaStore, or any list of uint8 arrays of letters)
         sequenceLen = len(sequences)
         results = [] #this is a list of dictionaries
-        # might be able to skip calculating when the strings are the same by comparing the indices before calling calcAlignCost
 
+        # We only want to compare two sequences once, so only the top half of the array gets a real alignment
         for i in range(sequenceLen):
-            jresults = []
-
-            # We only want to compare two sequences once, so we fill redundant cells with 0's (only do the top half of the array)
+            jresults = [None] * sequenceLen
             for n in range(i):
                 #don't calc alignCost, this cell is redundant
-                s = {'align_cost': 0,
-                     'seqi_first100': 'abc-easy  DEBUG:(seq{}, {} chars,align_len={}{})'.format(i + 1,
-                     len(sequences[i]),align_length,',BANDED' if banded else ''),
-                     'seqj_first100': 'as-123--  DEBUG:(seq{}, {} chars,align_len={}{})'.format(j + 1,
-                     len(sequences[j]),align_length,',BANDED' if banded else '')}
-                jresults.append(s)
-
-            for j in range(i, sequenceLen): # using i tells it to only do the top half of the array
-                #print(">ALIGN(), comparing seq "+str(i) + " and seq "+str(j))
-
-                alignCost, backPtrArray = self.calcAlignCost(sequences[i], sequences[j], banded, align_length)
-                if alignCost == float('inf'):
-                    seqiAlignment = "No Alignment Possible" #if the string lengths were too different,
-                    seqjAlignment = "No Alignment Possible" # don't bother to calc the alignment strings
-                else:
-                    seqiAlignment, seqjAlignment = self.getSeqAlignments(sequences[i], sequences[j], backPtrArray, align_length)
-
-                s = {'align_cost':alignCost,
-                     'seqi_first100':seqiAlignment +'  DEBUG:(seq{}, {} chars,align_len={}{})'.format(i+1,
-                         len(sequences[i]), align_length, ',BANDED' if banded else ''),
-                     'seqj_first100':seqjAlignment +'  DEBUG:(seq{}, {} chars,align_len={}{})'.format(j+1,
-                         len(sequences[j]), align_length, ',BANDED' if banded else '')}
-                jresults.append(s)
+                jresults[n] = self.makeResult(sequences, i, n, 0, 'abc-easy', 'as-123--', banded, align_length)
             results.append(jresults)
 
-        print(">ALIGNALL(): done")
+        pairs = [(i, j) for i in range(sequenceLen) for j in range(i, sequenceLen)]
+        cacheKeys = {}
+
+        # Fills in cell (i, j) and hands freshly computed results to the cache
+        def record(i, j, alignCost, seqiAlignment, seqjAlignment):
+            results[i][j] = self.makeResult(sequences, i, j, alignCost, seqiAlignment, seqjAlignment, banded, align_length)
+            if (i, j) in cacheKeys:
+                self.cache.put(cacheKeys[(i, j)], (alignCost, seqiAlignment, seqjAlignment))
+
+        # Pull whatever we've already aligned out of the cache, and only schedule the rest
+        if self.cache is not None:
+            digests = [self.cache.sequenceDigest(seq) for seq in self.truncateAll(sequences, align_length)]
+            remaining = []
+            for i, j in pairs:
+                key = self.cache.makeKey(digests[i], digests[j], banded, align_length, mode, bandWidth, scoring)
+                cached = self.cache.get(key)
+                if cached is None:
+                    cacheKeys[(i, j)] = key
+                    remaining.append((i, j))
+                else:
+                    record(i, j, *cached)
+            pairs = remaining
+
+        if workers is None or workers > 1:
+            workers = workers or os.cpu_count() or 1
+            with ProcessPoolExecutor(max_workers=workers, initializer=_initAlignWorker,
+                                     initargs=(sequences, banded, align_length, mode, bandWidth, scoring)) as pool:
+                tasks = [pool.submit(_alignChunk, chunk)
+                         for chunk in self.makeAlignChunks(sequences, pairs, banded, align_length, workers, chunkSize, bandWidth)]
+                # fill in each chunk as soon as it comes back
+                for task in as_completed(tasks):
+                    for pairResult in task.result():
+                        record(*pairResult)
+        else:
+            # encode each sequence once up front instead of once per pair
+            codes = [self.encodeSequence(seq) for seq in self.truncateAll(sequences, align_length)]
+            for i, j in pairs:
+                record(i, j, *self.alignPair(codes[i], codes[j], banded, align_length, mode, bandWidth, scoring))
+
+        if self.cache is not None:
+            self.cache.flush()
+
+        if METRICS.enabled:
+            METRICS.count('align.pairs', len(pairs))
         return results
 
-    # Goes through the backPtrArray with the two seq's and determine what the alignment strings will be for them
-    def getSeqAlignments(self, seq1, seq2, backPtrArray, alignLen):
+    # Aligns one pair of sequences, returns (cost, seqi alignment string, seqj alignment string)
+    def alignPair(self, seq1, seq2, banded, align_length, mode=MODE_FULL, bandWidth=BAND_WIDTH, scoring=None):
+        alignCost, backPtrArray = self.calcAlignCost(seq1, seq2, banded, align_length, mode, bandWidth, scoring)
+        if alignCost == float('inf'):
+            seqiAlignment = "No Alignment Possible" #if the string lengths were too different,
+            seqjAlignment = "No Alignment Possible" # don't bother to calc the alignment strings
+        elif backPtrArray is None:
+            seqiAlignment = "" # cost only mode doesn't keep anything to trace back through
+            seqjAlignment = ""
+        else:
+            seqiAlignment, seqjAlignment = self.getSeqAlignments(seq1, seq2, backPtrArray, align_length)
+        return alignCost, seqiAlignment, seqjAlignment
+
+    # seq[:align_length] for every sequence - from a FastaStore only that much of each record is read
+    def truncateAll(self, sequences, align_length):
+        if isinstance(sequences, FastaStore):
+            return [sequences.sequence(i, align_length) for i in range(len(sequences))]
+        return [seq[:align_length] for seq in sequences]
+
+    # len(sequences[i]), without pulling a whole FastaStore record into memory for it
+    def sequenceLength(self, sequences, i):
+        if isinstance(sequences, FastaStore):
+            return sequences.lengths[i]
+        return len(sequences[i])
 
-        x = len(seq1)
-        if x > alignLen:
-            x = alignLen
-        y = len(seq2)
-        if y > alignLen:
-            y = alignLen
+    # Builds the dictionary the GUI reads for cell (i, j) of the results table
+    def makeResult(self, sequences, i, j, alignCost, seqiAlignment, seqjAlignment, banded, align_length):
+        return {'align_cost':alignCost,
+                'seqi_first100':seqiAlignment +'  DEBUG:(seq{}, {} chars,align_len={}{})'.format(i+1,
+                    self.sequenceLength(sequences, i), align_length, ',BANDED' if banded else ''),
+                'seqj_first100':seqjAlignment +'  DEBUG:(seq{}, {} chars,align_len={}{})'.format(j+1,
+                    self.sequenceLength(sequences, j), align_length, ',BANDED' if banded else '')}
 
-        # convert strings to array so we can use list.insert() - convert these to strings and return them at the end
-        seqiAlignment = list(seq1)
-        seqjAlignment = list(seq2)
+    # Orders the pairs biggest first and groups them into chunks for the process pool
+    # Without a chunkSize, a chunk is closed once its estimated cost hits ~1/4 of a worker's share,
+    # so the expensive pairs go out alone and the cheap ones get batched together
+    def makeAlignChunks(self, sequences, pairs, banded, align_length, workers, chunkSize=None, bandWidth=BAND_WIDTH):
+        def pairCost(pair):
+            rows = min(self.sequenceLength(sequences, pair[0]), align_length) + 1
+            cols = min(self.sequenceLength(sequences, pair[1]), align_length) + 1
+            return rows * (2 * bandWidth + 1 if banded else cols)
 
-        # Backtrack through backPtrArray and build each alignment string
+        costs = {pair: pairCost(pair) for pair in pairs}
+        ordered = sorted(pairs, key=lambda pair: costs[pair], reverse=True)
 
-        while x is not 0 or y is not 0:
-            if backPtrArray[x][y] is DIAG:
+        if chunkSize is not None:
+            return [ordered[k:k + chunkSize] for k in range(0, len(ordered), chunkSize)]
+
+        budget = max(1, sum(costs.values()) // (workers * 4))
+        chunks = []
+        chunk = []
+        chunkCost = 0
+        for pair in ordered:
+            chunk.append(pair)
+            chunkCost += costs[pair]
+            if chunkCost >= budget:
+                chunks.append(chunk)
+                chunk = []
+                chunkCost = 0
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
+    # Goes through the backPtrArray with the two seq's and determine what the alignment strings will be for them
+    # (backPtrArray is a PackedBackPtrs, or the op script built by the Hirschberg mode)
+    # Only the first DISPLAY_LEN columns are built unless full is True
+    def getSeqAlignments(self, seq1, seq2, backPtrArray, alignLen, full=False):
+        seq1 = self.asText(seq1[:alignLen])
+        seq2 = self.asText(seq2[:alignLen])
+        if isinstance(backPtrArray, bytearray):
+            return self.getScriptAlignments(seq1, seq2, backPtrArray, full)
+
+        x = backPtrArray.rows - 1
+        y = backPtrArray.cols - 1
+
+        # Column t of the alignment ends on a cell with x + y <= 2t, so anything further out than that
+        # can't land in the displayed part - keep walking back, but don't build letters for it
+        window = x + y if full else 2 * DISPLAY_LEN
+
+        # Backtrack through backPtrArray and build each alignment string backwards, one letter per step
+        seqiAlignment = []
+        seqjAlignment = []
+        while x != 0 or y != 0:
+            ptr = backPtrArray.get(x, y)
+            build = x + y <= window
+            if ptr == DIAG:
                 # keep the two letters the same for each alignment str
-                # don't change either alignment str but decrement x and y
+                if build:
+                    seqiAlignment.append(seq1[x-1])
+                    seqjAlignment.append(seq2[y-1])
                 x -= 1
                 y -= 1
-            elif backPtrArray[x][y] is LEFT:
+            elif ptr == LEFT:
                 # put a dash in the seqjAlignment string
-                seqjAlignment.insert(x+1, '-')
-                x -= 1  # move a column left
-
-            elif backPtrArray[x][y] is UP:
+                if build:
+                    seqiAlignment.append(seq1[x-1])
+                    seqjAlignment.append('-')
+                x -= 1
+            else:
                 # put a dash in the seqiAlignment string
-                seqiAlignment.insert(y+1, '-')
-                y -= 1  # move a row up
+                if build:
+                    seqiAlignment.append('-')
+                    seqjAlignment.append(seq2[y-1])
+                y -= 1
+
+        seqiAlignment.reverse()
+        seqjAlignment.reverse()
+        if not full:
+            del seqiAlignment[DISPLAY_LEN:]
+            del seqjAlignment[DISPLAY_LEN:]
+        return ''.join(seqiAlignment), ''.join(seqjAlignment)
 
-        string1 = ''.join(seqiAlignment[0:100])
-        string2 = ''.join(seqjAlignment[0:100])
-        return string1, string2
+    # Walks an op script forward and builds the first DISPLAY_LEN chars of each alignment string (or all of them)
+    # A LocalScript starts wherever its alignment does, anything else at the beginning of both sequences
+    def getScriptAlignments(self, seq1, seq2, script, full=False):
+        seqiAlignment = []
+        seqjAlignment = []
+        i, j = script.start if isinstance(script, LocalScript) else (0, 0)
+        for op in script:
+            if not full and len(seqiAlignment) >= DISPLAY_LEN:
+                break
+            if op == DIAG:
+                seqiAlignment.append(seq1[i])
+                seqjAlignment.append(seq2[j])
+                i += 1
+                j += 1
+            elif op == LEFT:
+                # seq1's letter lines up with a dash
+                seqiAlignment.append(seq1[i])
+                seqjAlignment.append('-')
+                i += 1
+            else:
+                # seq2's letter lines up with a dash
+                seqiAlignment.append('-')
+                seqjAlignment.append(seq2[j])
+                j += 1
+
+        return ''.join(seqiAlignment), ''.join(seqjAlignment)
 
 
     # Runs the dynamic programming algorithm on the two given sequences
-    def calcAlignCost(self, seq1, seq2, banded, alignLen):
-        # CONSTANTS
-        MATCH = -3
-        MISMATCH = 1
-        INDEL = 5
-
-        lenS1 = len(seq1)+1 # truncate seq1 if necessary
-        if lenS1 > alignLen+1:
-            lenS1 = alignLen+1
-        lenS2 = len(seq2)+1 # truncate seq2 if necessary
-        if lenS2 > alignLen+1:
-            lenS2 = alignLen+1
-        costArray, backPtrArray = self.initArrays(lenS1, lenS2)
-
-        for x in range(1, lenS1): # for each row
-            if banded:
-                rowStart = x - 3
-                if rowStart < 1:
-                    rowStart = 1
-                rowEnd = x + 4
-                if rowEnd > lenS2:
-                    rowEnd = lenS2 #x is the midpoint, midpoint + 4 will keep it within 7
-            else:
+    # Returns (cost, backPtrArray) - backPtrArray is None in cost only mode and an op script in Hirschberg mode
+    # (and for any scoring other than the default one, see calcScoredAlignCost)
+    def calcAlignCost(self, seq1, seq2, banded, alignLen, mode=MODE_FULL, bandWidth=BAND_WIDTH, scoring=None):
+        if scoring is not None and not scoring.isDefault():
+            self.checkScoring(mode, scoring)
+            return self.calcScoredAlignCost(seq1, seq2, banded, alignLen, mode, bandWidth, scoring)
+        if banded:
+            return self.calcBandedAlignCost(seq1, seq2, alignLen, mode, bandWidth)
+        if mode == MODE_COST:
+            return self.calcAlignCostLinear(seq1, seq2, alignLen), None
+        if mode == MODE_HIRSCHBERG:
+            return self.calcAlignHirschberg(seq1, seq2, alignLen)
+
+        codes1 = self.encodeSequence(seq1[:alignLen]) # truncate the sequences if necessary
+        codes2 = self.encodeSequence(seq2[:alignLen])
+        backPtrs = PackedBackPtrs(len(codes1) + 1, len(codes2) + 1)
+        return int(self.lastRow(codes1, codes2, backPtrs)[-1]), backPtrs
+
+
+    # Turns a sequence into an array of integer codes so letters can be compared a whole row at a time
+    # (arrays of codes are passed through, bytes-like sequences are viewed without a copy)
+    def encodeSequence(self, seq):
+        if isinstance(seq, np.ndarray):
+            return seq
+        if not isinstance(seq, str):
+            return np.frombuffer(seq, dtype=np.uint8)
+        try:
+            return np.frombuffer(seq.encode('ascii'), dtype=np.uint8)
+        except UnicodeEncodeError:
+            return np.array([ord(c) for c in seq], dtype=np.uint32)
+
+    # Turns a (truncated) sequence back into a string for building the alignment strings
+    def asText(self, seq):
+        if isinstance(seq, str):
+            return seq
+        if isinstance(seq, np.ndarray) and seq.dtype != np.uint8:
+            return ''.join(map(chr, seq.tolist()))
+        return bytes(seq).decode('latin-1')
+
+    # Cost only version of calcAlignCost - never holds more than two rows at a time
+    def calcAlignCostLinear(self, seq1, seq2, alignLen):
+        codes1 = self.encodeSequence(seq1[:alignLen])
+        codes2 = self.encodeSequence(seq2[:alignLen])
+        return int(self.lastRow(codes1, codes2)[-1])
+
+    # Banded version of calcAlignCost - only the 2d+1 cells around the diagonal of each row are ever stored,
+    # so memory is O(n*d) with back pointers and O(d) in cost only mode
+    def calcBandedAlignCost(self, seq1, seq2, alignLen, mode, bandWidth):
+        codes1 = self.encodeSequence(seq1[:alignLen])
+        codes2 = self.encodeSequence(seq2[:alignLen])
+
+        # if the lengths differ by more than d the bottom right corner is outside the band, so no alignment possible
+        if abs(len(codes1) - len(codes2)) > bandWidth:
+            return float('inf'), None
+
+        if mode == MODE_COST:
+            return self.bandedDP(codes1, codes2, bandWidth), None
+
+        backPtrs = PackedBackPtrs(len(codes1) + 1, len(codes2) + 1, bandWidth)
+        return self.bandedDP(codes1, codes2, bandWidth, backPtrs), backPtrs
+
+    # Runs the DP one whole row at a time and returns the last row of costs (codes1 down the side, codes2 across the top)
+    # Fills in backPtrs row by row when it's given
+    def lastRow(self, codes1, codes2, backPtrs=None):
+        m = len(codes2)
+        if METRICS.enabled:
+            METRICS.count('align.dp_cells', len(codes1) * m)
+        offsets = np.arange(m + 1, dtype=np.int64) * INDEL
+        row = offsets.copy()
+        subCosts = {} # letter -> cost of lining it up with every letter of codes2
+        if backPtrs is not None:
+            backPtrs.setRow(0, np.full(m + 1, UP, dtype=np.uint8))
+            ptrRow = np.empty(m + 1, dtype=np.uint8)
+
+        for x in range(1, len(codes1) + 1):
+            letter = codes1[x-1]
+            sub = subCosts.get(letter)
+            if sub is None:
+                sub = np.where(codes2 == letter, MATCH, MISMATCH).astype(np.int64)
+                subCosts[letter] = sub
+
+            # best of coming diagonally or from the previous row
+            diagCost = row[:-1] + sub
+            leftCost = row[1:] + INDEL
+            cur = np.empty(m + 1, dtype=np.int64)
+            cur[0] = x * INDEL
+            np.minimum(diagCost, leftCost, out=cur[1:])
+            noGapInRow = cur.copy() if backPtrs is not None else None
+
+            # gaps within the row: cur[y] = min over k <= y of cur[k] + (y-k)*INDEL, which is a running min
+            cur -= offsets
+            np.minimum.accumulate(cur, out=cur)
+            cur += offsets
+
+            if backPtrs is not None:
+                # diagonal, then LEFT if strictly better, then UP if strictly better
+                ptrRow[0] = LEFT
+                ptrRow[1:] = np.where(leftCost < diagCost, LEFT, DIAG)
+                ptrRow[cur < noGapInRow] = UP
+                backPtrs.setRow(x, ptrRow)
+            row = cur
+
+        return row
+
+    # Same as lastRow, but only keeps the 2d+1 cells around the diagonal of each row and returns the corner cell
+    # Band cell k of row x is column y = x - d + k. Fills in backPtrs row by row when it's given.
+    def bandedDP(self, codes1, codes2, d, backPtrs=None):
+        if METRICS.enabled:
+            METRICS.count('align.dp_cells', self.bandCells(len(codes1), len(codes2), d))
+        if 2 * d + 1 >= BAND_VECTOR_MIN_WIDTH:
+            return self.bandedDPVector(codes1, codes2, d, backPtrs)
+
+        n = len(codes1)
+        m = len(codes2)
+        width = 2 * d + 1
+        a = codes1.tolist()
+        b = codes2.tolist()
+        # pointers start out as LEFT (0), so only DIAG/UP ever need their bits OR'd in
+        ptrs = backPtrs.view if backPtrs is not None else None
+        stride = backPtrs.stride if backPtrs is not None else 0
+
+        # each band has one extra cell at the end that always stays BAND_INF, so cur[k-1] at k = 0 wraps onto it
+        # row 0 is fully initialized, so its extra cell (column d+1) is real
+        prev = [BAND_INF] * (width + 1)
+        for k in range(width + 1):
+            y = k - d
+            if 0 <= y <= m:
+                prev[k] = y * INDEL
+                if ptrs is not None and k < width:
+                    ptrs[k >> 2] |= UP << ((k & 3) << 1)
+
+        for x in range(1, n + 1):
+            cur = [BAND_INF] * (width + 1)
+            rowStart = x - d
+            if rowStart <= 0:
+                cur[d - x] = x * INDEL # column 0 is always initialized (and its pointer is already LEFT)
                 rowStart = 1
-                rowEnd = lenS2
+            rowEnd = min(m, x + d)
+            letter = a[x-1]
+            rowBase = x * stride
 
-            for y in range(rowStart, rowEnd):  # for each column
+            for y in range(rowStart, rowEnd + 1):
+                k = y - x + d
+                alignCost = prev[k] + (MATCH if letter == b[y-1] else MISMATCH)
+                ptr = DIAG
+                leftCost = prev[k+1] + INDEL
+                if leftCost < alignCost:
+                    alignCost = leftCost
+                    ptr = LEFT
+                aboveCost = cur[k-1] + INDEL
+                if aboveCost < alignCost:
+                    alignCost = aboveCost
+                    ptr = UP
+                cur[k] = alignCost
+                if ptrs is not None and ptr != LEFT:
+                    ptrs[rowBase + (k >> 2)] |= ptr << ((k & 3) << 1)
+            prev = cur
 
-                if seq1[x-1] == seq2[y-1]:
-                    # they match diagonally
-                    alignCost = costArray[x-1][y-1] + MATCH
-                    #backPtrArray already has a diagonal for this spot
-                else:
-                    # mismatch diagonally
-                    alignCost = costArray[x-1][y-1] + MISMATCH
-                    #backPtrArray already has a diagonal for this spot
-
-                if costArray[x-1][y] is not "-":
-                    # you can try coming from the side of the current cell
-                    leftCost = costArray[x-1][y] + INDEL
-                    if leftCost < alignCost:
-                        alignCost = leftCost
-                        backPtrArray[x][y] = LEFT
-
-                if costArray[x][y-1] is not "-":
-                    # you can try coming from above the current cell
-                    aboveCost = costArray[x][y-1] + INDEL
-                    if aboveCost < alignCost:
-                        alignCost = aboveCost
-                        backPtrArray[x][y] = UP
-
-                # alignCost is now the min value possible
-                costArray[x][y] = alignCost
-
-        # If one sequence is way longer than the other, most of the costArray is not used
-        # and the bottom right corner is still going to have the value it was init'd to (0)
-        if banded:
-            if abs(lenS1-lenS2) > 100: # "significant length discrepancies"
-                return float('inf'), backPtrArray  # no alignment possible because the strings were too different
-            value = costArray[lenS1-1][lenS2-1]
-            return value, backPtrArray
-
-        value = costArray[lenS1-1][lenS2-1]
-        return value, backPtrArray
-
-
-    # initializes the 2D costArray to be all 0's with the first row/col being multiples of 5
-    # intiializes the 2D backPtrArray
-    # (lenS1 and lenS2 have already had +1 applied)
-    def initArrays(self, lenS1, lenS2):
-        #init costArray to be full of 0's
-        costArray = [["-" for x in range(lenS2)] for y in range(lenS1)] #TEST
-        #init backPtrArray to always a diagonal, and changing it to leftside/above later if necessary
-        backPtrArray = [[DIAG for x in range(lenS2)] for y in range(lenS1)]
-
-        # init the first row/col of costArray to be multiples of 5
-        # init the first row/col of backPtrArray to be all left (first row) and all up (first col)
+        return prev[m - n + d]
+
+    # How many cells of an n x m DP (not counting row/column 0) are within d of the diagonal
+    def bandCells(self, n, m, d):
+        return sum(min(m, x + d) - max(1, x - d) + 1 for x in range(1, n + 1) if max(1, x - d) <= min(m, x + d))
+
+    # NumPy version of bandedDP for wide bands - each band row is filled with a handful of vector operations
+    def bandedDPVector(self, codes1, codes2, d, backPtrs=None):
+        n = len(codes1)
+        m = len(codes2)
+
+        width = 2 * d + 1
+        ks = np.arange(width, dtype=np.int64)
+        offsets = ks * INDEL
+        # pad codes2 so every band lines up with a full slice (padding cells are thrown away below)
+        padded = np.concatenate((np.zeros(d + 1, dtype=codes2.dtype), codes2, np.zeros(width, dtype=codes2.dtype)))
+
+        # row 0 is fully initialized, so its band plus the cell right after it are all real
+        ys = ks - d
+        prev = np.where((ys >= 0) & (ys <= m), ys * INDEL, BAND_INF)
+        prevExt = np.empty(width + 1, dtype=np.int64)
+        if backPtrs is not None:
+            backPtrs.setRow(0, np.full(width, UP, dtype=np.uint8))
+
+        for x in range(1, n + 1):
+            ys = ks + (x - d)
+            prevExt[:width] = prev
+            if x == 1 and d + 1 <= m:
+                prevExt[width] = (d + 1) * INDEL
+            else:
+                prevExt[width] = BAND_INF
+
+            sub = np.where(padded[x:x + width] == codes1[x-1], MATCH, MISMATCH)
+            diagCost = prevExt[:-1] + sub
+            leftCost = prevExt[1:] + INDEL
+            cur = np.minimum(diagCost, leftCost)
+            outside = (ys < 1) | (ys > m)
+            cur[outside] = BAND_INF
+            if x - d <= 0:
+                cur[d - x] = x * INDEL # column 0 is always initialized
+            noGapInRow = cur.copy() if backPtrs is not None else None
+
+            cur -= offsets
+            np.minimum.accumulate(cur, out=cur)
+            cur += offsets
+
+            if backPtrs is not None:
+                # same tie breaking as the full DP: diagonal, then LEFT if strictly better, then UP if strictly better
+                ptrRow = np.where(leftCost < diagCost, LEFT, DIAG).astype(np.uint8)
+                ptrRow[cur < noGapInRow] = UP
+                if x - d <= 0:
+                    ptrRow[d - x] = LEFT
+                backPtrs.setRow(x, ptrRow)
+
+            cur[outside] = BAND_INF
+            if x - d <= 0:
+                cur[d - x] = x * INDEL
+            prev = cur
+
+        return int(prev[m - n + d])
+
+    # Linear memory alignment: returns the cost and an op script (one DIAG/LEFT/UP per alignment column)
+    def calcAlignHirschberg(self, seq1, seq2, alignLen):
+        codes1 = self.encodeSequence(seq1[:alignLen])
+        codes2 = self.encodeSequence(seq2[:alignLen])
+
+        script = bytearray()
+        self.hirschberg(codes1, codes2, script)
+
+        # add the cost back up from the script instead of running another pass
+        cost = 0
+        x = 0
+        y = 0
+        for op in script:
+            if op == DIAG:
+                cost += MATCH if codes1[x] == codes2[y] else MISMATCH
+                x += 1
+                y += 1
+            elif op == LEFT:
+                cost += INDEL
+                x += 1
+            else:
+                cost += INDEL
+                y += 1
+
+        return cost, script
+
+    # Splits codes1 in half, finds where the optimal path crosses the middle row, and recurses on both halves
+    def hirschberg(self, codes1, codes2, script):
+        n = len(codes1)
+        m = len(codes2)
+        if n == 0:
+            script.extend(bytes([UP]) * m)
+            return
+        if m == 0:
+            script.extend(bytes([LEFT]) * n)
+            return
+        if n == 1 or m == 1 or n * m <= HIRSCHBERG_BASE_CELLS:
+            script.extend(self.smallAlignScript(codes1, codes2))
+            return
+
+        mid = n // 2
+        upper = self.lastRow(codes1[:mid], codes2)
+        lower = self.lastRow(codes1[mid:][::-1], codes2[::-1])[::-1]
+        split = int(np.argmin(upper + lower))
+
+        self.hirschberg(codes1[:mid], codes2[:split], script)
+        self.hirschberg(codes1[mid:], codes2[split:], script)
+
+    # Plain DP with back pointers for small Hirschberg subproblems, returns the ops in forward order
+    def smallAlignScript(self, codes1, codes2):
+        a = codes1.tolist()
+        b = codes2.tolist()
+        if METRICS.enabled:
+            METRICS.count('align.dp_cells', len(a) * len(b))
+        lenS1 = len(a) + 1
+        lenS2 = len(b) + 1
+        costArray = [[0] * lenS2 for x in range(lenS1)]
+        backPtrArray = [[DIAG] * lenS2 for x in range(lenS1)]
         for x in range(lenS1):
-            costArray[x][0] = x * 5
+            costArray[x][0] = x * INDEL
             backPtrArray[x][0] = LEFT
         for y in range(lenS2):
-            costArray[0][y] = y * 5
+            costArray[0][y] = y * INDEL
             backPtrArray[0][y] = UP
 
-        return costArray, backPtrArray
+        for x in range(1, lenS1):
+            prevRow = costArray[x-1]
+            row = costArray[x]
+            ptrRow = backPtrArray[x]
+            for y in range(1, lenS2):
+                alignCost = prevRow[y-1] + (MATCH if a[x-1] == b[y-1] else MISMATCH)
+                leftCost = prevRow[y] + INDEL
+                if leftCost < alignCost:
+                    alignCost = leftCost
+                    ptrRow[y] = LEFT
+                aboveCost = row[y-1] + INDEL
+                if aboveCost < alignCost:
+                    alignCost = aboveCost
+                    ptrRow[y] = UP
+                row[y] = alignCost
+
+        ops = bytearray()
+        x = lenS1 - 1
+        y = lenS2 - 1
+        while x != 0 or y != 0:
+            op = backPtrArray[x][y]
+            ops.append(op)
+            if op == DIAG:
+                x -= 1
+                y -= 1
+            elif op == LEFT:
+                x -= 1
+            else:
+                y -= 1
+        ops.reverse()
+        return ops
+
+
+    # Hirschberg only knows the linear MATCH/MISMATCH/INDEL costs
+    def checkScoring(self, mode, scoring):
+        if mode == MODE_HIRSCHBERG and scoring is not None and not scoring.isDefault():
+            raise ValueError('Hirschberg mode only works with the default scoring')
+
+    # calcAlignCost for any Scoring: returns (cost, op script), where the script is a LocalScript for local
+    # alignments, or (cost, None) in cost only mode
+    def calcScoredAlignCost(self, seq1, seq2, banded, alignLen, mode, bandWidth, scoring):
+        codes1 = self.encodeSequence(seq1[:alignLen])
+        codes2 = self.encodeSequence(seq2[:alignLen])
+        n = len(codes1)
+        m = len(codes2)
+        d = bandWidth if banded else None
+
+        # a global alignment has to end in the bottom right corner, so that has to be in the band
+        if banded and scoring.alignment == ALIGN_GLOBAL and abs(n - m) > bandWidth:
+            return float('inf'), None
+
+        if n == 0 or m == 0:
+            # nothing to line up - one gap (free unless it's global), or nothing at all for local
+            if scoring.alignment == ALIGN_LOCAL:
+                return 0, None if mode == MODE_COST else LocalScript(b'', (0, 0))
+            cost = scoring.gapOpen + (n + m) * scoring.gapExtend if scoring.alignment == ALIGN_GLOBAL and n + m else 0
+            return cost, None if mode == MODE_COST else bytearray(bytes([LEFT]) * n + bytes([UP]) * m)
+
+        cost, end, trace = self.scoredDP(codes1, codes2, scoring, d, mode != MODE_COST)
+        if trace is None:
+            return cost, None
+        return cost, self.scoredScript(n, m, end, trace, scoring, d)
+
+    # Gotoh's affine gap DP for any Scoring, one row at a time (codes1 down the side, codes2 across the top).
+    # Every cell has three costs: H, the best of any kind, left, the best ending in a LEFT gap (from the row above),
+    # and up, the best ending in an UP gap (from the cell before it in the same row). H and left for a whole row
+    # come from the row above with a few vector operations on the query profile, in int32 whenever the costs
+    # can't get big enough to overflow it. up depends on the cells before it in the same row, but because gaps
+    # never get cheaper by being reopened, up[y] = min over k < y of H'[k] + gapOpen + (y - k) * gapExtend, where
+    # H' is H before any up gaps - one running minimum, the same trick lastRow uses for its gaps.
+    # Banded (d given), only the cells within d of the diagonal are worked out.
+    # Returns (cost, end cell, trace): trace[x] holds the TRACE_ bits of row x (only its band, when banded),
+    # and is None when trace is False.
+    def scoredDP(self, codes1, codes2, scoring, d=None, trace=False):
+        n = len(codes1)
+        m = len(codes2)
+        alignment = scoring.alignment
+        gapOpen = scoring.gapOpen
+        extend = scoring.gapExtend
+        openExtend = gapOpen + extend
+        if (n + m + 2) * scoring.maxStepCost() < SCORED_INT32_LIMIT:
+            dtype, inf = np.int32, 2 * SCORED_INT32_LIMIT
+        else:
+            dtype, inf = np.int64, BAND_INF
+        if METRICS.enabled:
+            METRICS.count('align.dp_cells', n * m if d is None else self.bandCells(n, m, d))
+
+        profile, profileRows = scoring.queryProfile(codes1, codes2)
+        profile = profile.astype(dtype)
+        columns = np.arange(m + 1, dtype=dtype)
+        columnGaps = columns * extend
+
+        # row 0: a gap along the top edge (free unless it's global), nothing ends in a LEFT gap yet
+        if alignment == ALIGN_GLOBAL:
+            H = columnGaps + gapOpen
+            H[0] = 0
+        else:
+            H = np.zeros(m + 1, dtype=dtype)
+        left = np.full(m + 1, inf, dtype=dtype)
+        if d is not None:
+            H[d + 1:] = inf
+        traceRows = np.zeros((n + 1, m + 1 if d is None else 2 * d + 1), dtype=np.uint8) if trace else None
+
+        # local alignments end at the lowest cell anywhere (the empty one at (0, 0) to start with), semi-global
+        # ones at the lowest cell in the last row or column
+        best = 0 if alignment == ALIGN_LOCAL else inf
+        bestCell = (0, 0)
+        if alignment == ALIGN_SEMIGLOBAL and (d is None or m <= d):
+            best = 0
+            bestCell = (0, m)
+
+        lastRow = n
+        for x in range(1, n + 1):
+            lo = 1 if d is None else max(1, x - d)
+            hi = m if d is None else min(m, x + d)
+            if lo > hi:
+                lastRow = x - 1 # the band has run off the right edge, so there's nothing more to work out
+                break
+            border = 0 if alignment != ALIGN_GLOBAL else gapOpen + x * extend
+            before = border if lo == 1 and (d is None or x <= d) else inf # H of the cell before lo in this row
+
+            diag = H[lo - 1:hi] + profile[profileRows[x - 1], lo - 1:hi]
+            newLeft = np.minimum(H[lo:hi + 1] + openExtend, left[lo:hi + 1] + extend)
+            noUp = np.minimum(diag, newLeft)
+            if alignment == ALIGN_LOCAL:
+                np.minimum(noUp, 0, out=noUp)
+
+            # up[y] = min over k < y of (noUp[k] - k * extend), plus gapOpen + y * extend
+            scan = np.empty(hi - lo + 2, dtype=dtype)
+            scan[0] = before
+            scan[1:] = noUp
+            scan -= columnGaps[lo - 1:hi + 1]
+            np.minimum.accumulate(scan, out=scan)
+            newUp = scan[:-1] + columnGaps[lo:hi + 1] + gapOpen
+            newH = np.minimum(noUp, newUp)
+
+            if trace:
+                # diagonal, then LEFT if strictly better, then UP if strictly better (then a fresh local start)
+                cells = np.where(newLeft < diag, LEFT, DIAG).astype(np.uint8)
+                cells[newUp < np.minimum(diag, newLeft)] = UP
+                if alignment == ALIGN_LOCAL:
+                    cells[np.minimum(np.minimum(diag, newLeft), newUp) > 0] = TRACE_STOP
+                cells[H[lo:hi + 1] + openExtend <= left[lo:hi + 1] + extend] |= TRACE_LEFT_OPEN
+                hBefore = np.concatenate(([before], newH[:-1]))
+                upBefore = np.concatenate(([inf], newUp[:-1]))
+                cells[hBefore + openExtend <= upBefore + extend] |= TRACE_UP_OPEN
+                start = lo if d is None else lo - x + d
+                traceRows[x, start:start + len(cells)] = cells
+
+            H[lo:hi + 1] = newH
+            left[lo:hi + 1] = newLeft
+            H[0] = border
+            if d is not None and hi < m:
+                # the next row's band reaches one column further, which has to read as out of band
+                H[hi + 1] = inf
+                left[hi + 1] = inf
+
+            if alignment == ALIGN_LOCAL:
+                y = int(newH.argmin())
+                if newH[y] < best:
+                    best = int(newH[y])
+                    bestCell = (x, lo + y)
+            elif alignment == ALIGN_SEMIGLOBAL and hi == m and newH[-1] < best:
+                best = int(newH[-1])
+                bestCell = (x, m)
+
+        if alignment == ALIGN_GLOBAL:
+            return int(H[m]), (n, m), traceRows
+        if alignment == ALIGN_SEMIGLOBAL and lastRow == n:
+            lo = 1 if d is None else max(1, n - d)
+            hi = m if d is None else min(m, n + d)
+            y = int(H[lo:hi + 1].argmin())
+            if H[lo + y] < best:
+                best = int(H[lo + y])
+                bestCell = (n, lo + y)
+            if (d is None or n <= d) and 0 < best:
+                best = 0 # all of codes1 against nothing, and then all of codes2
+                bestCell = (n, 0)
+        return best, bestCell, traceRows
+
+    # Follows scoredDP's trace back from the end cell and returns the op script of the alignment
+    def scoredScript(self, n, m, end, traceRows, scoring, d=None):
+        x, y = end
+        ops = bytearray()
+        if scoring.alignment == ALIGN_SEMIGLOBAL:
+            # whatever's after the end cell is a free gap at the end
+            ops.extend(bytes([LEFT]) * (n - x))
+            ops.extend(bytes([UP]) * (m - y))
+
+        state = DIAG # DIAG: at the cell's H, LEFT/UP: in the middle of that kind of gap
+        while x > 0 and y > 0:
+            cell = traceRows[x, y if d is None else y - x + d]
+            if state == DIAG:
+                source = cell & 3
+                if source == TRACE_STOP:
+                    break
+                if source == DIAG:
+                    ops.append(DIAG)
+                    x -= 1
+                    y -= 1
+                else:
+                    state = source
+            elif state == LEFT:
+                ops.append(LEFT)
+                state = DIAG if cell & TRACE_LEFT_OPEN else LEFT
+                x -= 1
+            else:
+                ops.append(UP)
+                state = DIAG if cell & TRACE_UP_OPEN else UP
+                y -= 1
+
+        if scoring.alignment == ALIGN_LOCAL:
+            ops.reverse()
+            return LocalScript(ops, (x, y))
+        # the rest runs along the top or left edge
+        ops.extend(bytes([LEFT]) * x)
+        ops.extend(bytes([UP]) * y)
+        ops.reverse()
+        return ops
+
+
+# Process pool workers - each one gets the sequences and settings once, then only (i, j) pairs are sent over
+_workerState = None
+
+def _initAlignWorker(sequences, banded, align_length, mode, bandWidth, scoring):
+    global _workerState
+    solver = GeneSequencing()
+    codes = [solver.encodeSequence(seq) for seq in solver.truncateAll(sequences, align_length)]
+    _workerState = (solver, codes, banded, align_length, mode, bandWidth, scoring)
+
+def _alignChunk(chunk):
+    solver, sequences, banded, align_length, mode, bandWidth, scoring = _workerState
+    results = []
+    for i, j in chunk:
+        alignCost, seqiAlignment, seqjAlignment = solver.alignPair(sequences[i], sequences[j], banded, align_length,
+                                                                   mode, bandWidth, scoring)
+        results.append((i, j, alignCost, seqiAlignment, seqjAlignment))
+    return results
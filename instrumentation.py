@@ -0,0 +1,149 @@
+#!/usr/bin/python3
+
+# Counters, phase timers and opt-in profiling for the solvers.
+#
+#   import instrumentation
+#   instrumentation.enable(captures=['computeShortestPaths'])
+#   solver.computeShortestPaths(0, True)
+#   instrumentation.export()  # {'counters': {...}, 'timers': {...}, 'captures': {...}}
+#
+# Everything is recorded on the module-level METRICS, and it's off by default. Switched off, the solvers pay one
+# `METRICS.enabled` check per call and nothing per heap operation, DP cell or multiplication: the hot loops keep
+# plain local counts (or work them out afterwards from what they already have) and only report them when it's on,
+# and the places that need a per-operation count swap in a counting version only while it's on.
+#
+# Counts come from the calling process only - process pool workers keep their own, which aren't collected.
+
+import contextlib
+import cProfile
+import functools
+import io
+import pstats
+import time
+import tracemalloc
+from collections import defaultdict
+
+# How many functions a capture's profile report lists
+PROFILE_TOP = 25
+
+
+# Times one phase into a Metrics object - METRICS.phase() hands these out while it's enabled
+class PhaseTimer:
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.timers[self.name] += time.perf_counter() - self.start
+        self.metrics.calls[self.name] += 1
+        return False
+
+
+class Metrics:
+    def __init__(self):
+        self.enabled = False
+        self.captured = frozenset()          # names of the @captured calls that get profiled
+        self.captureProfile = True
+        self.captureMemory = True
+        self.counters = defaultdict(int)
+        self.timers = defaultdict(float)     # phase name -> total seconds
+        self.calls = defaultdict(int)        # phase name -> how many times it ran
+        self.captures = {}                   # capture name -> report of its last run
+        self.disabledPhase = contextlib.nullcontext()
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    # with METRICS.phase('name'): ... adds the time spent inside to timers['name'] (does nothing while disabled)
+    def phase(self, name):
+        if not self.enabled:
+            return self.disabledPhase
+        return PhaseTimer(self, name)
+
+    # Runs the body under cProfile and/or tracemalloc and stores a report of it in captures[name]:
+    # wall time, the top PROFILE_TOP functions by cumulative time, and the peak traced memory
+    @contextlib.contextmanager
+    def capture(self, name, profile=True, memory=True):
+        profiler = cProfile.Profile() if profile else None
+        startedTracing = memory and not tracemalloc.is_tracing()
+        if startedTracing:
+            tracemalloc.start()
+        if memory:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            report = {'seconds': time.perf_counter() - start}
+            if memory:
+                report['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+                if startedTracing:
+                    tracemalloc.stop()
+            if profiler is not None:
+                text = io.StringIO()
+                pstats.Stats(profiler, stream=text).sort_stats('cumulative').print_stats(PROFILE_TOP)
+                report['profile'] = text.getvalue()
+            self.captures[name] = report
+
+    def reset(self):
+        self.counters.clear()
+        self.timers.clear()
+        self.calls.clear()
+        self.captures.clear()
+
+    # Everything recorded so far as plain dicts (ready for json.dump)
+    def export(self):
+        return {'counters': dict(self.counters),
+                'timers': {name: {'seconds': self.timers[name], 'calls': self.calls[name]} for name in self.timers},
+                'captures': dict(self.captures)}
+
+
+METRICS = Metrics()
+
+
+# Turns recording on. captures names the @captured calls (e.g. 'align_all') to profile every time they run;
+# profile/memory pick cProfile and/or tracemalloc for them.
+def enable(captures=(), profile=True, memory=True):
+    METRICS.enabled = True
+    METRICS.captured = frozenset(captures)
+    METRICS.captureProfile = profile
+    METRICS.captureMemory = memory
+
+
+def disable():
+    METRICS.enabled = False
+    METRICS.captured = frozenset()
+
+
+def reset():
+    METRICS.reset()
+
+
+def export():
+    return METRICS.export()
+
+
+# Decorator for the solvers' entry points: times every call as a phase while enabled, and runs it under
+# METRICS.capture when its name was passed to enable(captures=...)
+def captured(name):
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not METRICS.enabled:
+                return function(*args, **kwargs)
+            with METRICS.phase(name):
+                if name not in METRICS.captured:
+                    return function(*args, **kwargs)
+                with METRICS.capture(name, METRICS.captureProfile, METRICS.captureMemory):
+                    return function(*args, **kwargs)
+        return wrapper
+    return decorate
@@ -0,0 +1,59 @@
+#!/usr/bin/python3
+
+# Least recently used key -> value store with a memory budget, shared by the solvers' caches
+# (AlignmentCache's in-memory tier and ShortestPathTreeCache). The caller says how big a value is;
+# whenever a put() goes over maxBytes the least recently used entries are dropped until it fits again.
+
+from collections import OrderedDict
+
+
+class MemoryLRU:
+    # Rough per-entry bookkeeping cost (dict slot, tuple, key object) on top of what sizeOf counts
+    ENTRY_OVERHEAD = 200
+
+    # sizeOf(key, value) is the number of bytes value (and key, if it's worth counting) takes up
+    def __init__(self, maxBytes, sizeOf):
+        self.maxBytes = maxBytes
+        self.sizeOf = sizeOf
+        self.usedBytes = 0
+        self.entries = OrderedDict() # key -> value, least recently used first
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    # Keys from least to most recently used (a snapshot, so entries can be discarded while going through it)
+    def __iter__(self):
+        return iter(list(self.entries))
+
+    # Returns the value for key (and marks it as just used), or None
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is not None:
+            self.entries.move_to_end(key)
+        return value
+
+    # Stores value under key, replacing whatever was there. A value bigger than the whole budget isn't kept.
+    def put(self, key, value):
+        self.discard(key)
+        size = self.entrySize(key, value)
+        if size > self.maxBytes:
+            return
+        self.entries[key] = value
+        self.usedBytes += size
+        while self.usedBytes > self.maxBytes:
+            oldKey, oldValue = self.entries.popitem(last=False)
+            self.usedBytes -= self.entrySize(oldKey, oldValue)
+
+    def discard(self, key):
+        if key in self.entries:
+            self.usedBytes -= self.entrySize(key, self.entries.pop(key))
+
+    def clear(self):
+        self.entries.clear()
+        self.usedBytes = 0
+
+    def entrySize(self, key, value):
+        return self.sizeOf(key, value) + self.ENTRY_OVERHEAD
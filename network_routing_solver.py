@@ -2,175 +2,1210 @@
 
 
 from CS312Graph import *
+import hashlib
+import heapq
+import math
+import mmap
+import os
+import struct
+import tempfile
 import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+from instrumentation import METRICS, captured
+from memory_cache import MemoryLRU
+
+# Children per node in the indexed heap - 4 keeps the tree shallow without making each sift-down
+# compare against too many children
+HEAP_ARITY = 4
+# Marks "no incoming edge" in pred
+NO_EDGE = -1
+# Batch dist/pred matrices bigger than this go in a memory-mapped file instead of RAM
+BATCH_MEMORY_LIMIT = 256 << 20
+# Memory budget for the shortest path trees kept around by ShortestPathTreeCache
+TREE_CACHE_LIMIT = 64 << 20
+
+# Point-to-point search methods for getShortestPathBetween
+P2P_DIJKSTRA = 'dijkstra'            # plain Dijkstra that stops once the destination is settled
+P2P_BIDIRECTIONAL = 'bidirectional'  # Dijkstra from both ends at once, stops when the two searches meet
+P2P_ASTAR = 'astar'                  # A* with the straight line distance (scaled to stay admissible) as heuristic
+P2P_CH = 'ch'                        # upward searches in the contraction hierarchy (needs one, see initializeNetwork)
+                                     # - only pays off on road-like graphs, so it's never the default
+
+# Contraction hierarchy file header tag
+CH_MAGIC = b'CS312CH1'
+# A witness search settles at most this many nodes before it gives up and the shortcut gets added anyway
+WITNESS_SETTLE_LIMIT = 1000
+# Contraction stops once more than CH_CORE_MIN_NODES nodes are left and they have CH_CORE_MAX_DEGREE edges each
+# on average. Graphs with geometric structure only get that dense in the last few hundred nodes, which are cheap
+# to contract even when they're nearly a complete graph; graphs without any (like the GUI's random networks)
+# get there with most of the graph still to go, and contracting all of it would take hours
+CH_CORE_MAX_DEGREE = 16
+CH_CORE_MIN_NODES = 300
+
+
+# Indexed d-ary min heap of node ids, ordered by keys[node] (the caller's dist array - the heap never copies it).
+# position[node] is where node sits in the heap (-1 if it isn't in it), which is what makes decreaseKey O(log n):
+# the caller lowers keys[node] and the node is sifted up from where it already is.
+class IndexedHeap:
+    def __init__(self, keys, arity=HEAP_ARITY):
+        self.keys = keys
+        self.arity = arity
+        self.heap = []
+        self.position = [-1] * len(keys)
+
+    def __len__(self):
+        return len(self.heap)
+
+    def __contains__(self, node):
+        return self.position[node] >= 0
+
+    # The node with the smallest key, without removing it
+    def peek(self):
+        return self.heap[0]
+
+    def push(self, node):
+        self.heap.append(node)
+        self.position[node] = len(self.heap) - 1
+        self.siftUp(len(self.heap) - 1)
+
+    # keys[node] has just gone down - move node up to where it belongs
+    def decreaseKey(self, node):
+        self.siftUp(self.position[node])
+
+    # Removes and returns the node with the smallest key
+    def popMin(self):
+        heap = self.heap
+        root = heap[0]
+        last = heap.pop()
+        self.position[root] = -1
+        if heap:
+            heap[0] = last
+            self.position[last] = 0
+            self.siftDown(0)
+        return root
+
+    def siftUp(self, i):
+        heap = self.heap
+        keys = self.keys
+        position = self.position
+        node = heap[i]
+        key = keys[node]
+        while i > 0:
+            parentIndex = (i - 1) // self.arity
+            parent = heap[parentIndex]
+            if keys[parent] <= key:
+                break
+            heap[i] = parent
+            position[parent] = i
+            i = parentIndex
+        heap[i] = node
+        position[node] = i
+
+    # Stops as soon as no child is smaller - the rest of the heap is already in order
+    def siftDown(self, i):
+        heap = self.heap
+        keys = self.keys
+        position = self.position
+        arity = self.arity
+        size = len(heap)
+        node = heap[i]
+        key = keys[node]
+        while True:
+            first = i * arity + 1
+            if first >= size:
+                break
+            minChild = first
+            minKey = keys[heap[first]]
+            for c in range(first + 1, min(first + arity, size)):
+                if keys[heap[c]] < minKey:
+                    minChild = c
+                    minKey = keys[heap[c]]
+            if minKey >= key:
+                break
+            heap[i] = heap[minChild]
+            position[heap[i]] = i
+            i = minChild
+        heap[i] = node
+        position[node] = i
+
+
+# IndexedHeap that also counts its operations into METRICS - see makeHeap
+class CountingIndexedHeap(IndexedHeap):
+    def push(self, node):
+        METRICS.counters['routing.heap_pushes'] += 1
+        IndexedHeap.push(self, node)
+
+    def decreaseKey(self, node):
+        METRICS.counters['routing.heap_decrease_keys'] += 1
+        IndexedHeap.decreaseKey(self, node)
+
+    def popMin(self):
+        METRICS.counters['routing.heap_pops'] += 1
+        return IndexedHeap.popMin(self)
+
+
+# The heap every search uses: the counting one while metrics are on, so the plain one never pays for counting
+def makeHeap(keys):
+    return CountingIndexedHeap(keys) if METRICS.enabled else IndexedHeap(keys)
+
+
+# How many edges the settled nodes have between them - every one of them got relaxed once. Worked out after a
+# search (and only while metrics are on) instead of counting inside the relax loop.
+def countRelaxations(offsets, settled):
+    METRICS.count('routing.edge_relaxations',
+                  sum(offsets[u + 1] - offsets[u] for u in range(len(settled)) if settled[u]))
+
+
+# Shortest path trees from a batch of sources: row r of dist/pred is what computeShortestPaths(sources[r])
+# would leave in self.dist/self.pred. With a path the two matrices live in that file (dist first, then pred)
+# through np.memmap, so they can be bigger than RAM; a temporary file is deleted again by close().
+class ShortestPathMatrix:
+    def __init__(self, sources, nodeCount, predType, path=None, temporary=False, mode='w+'):
+        self.sources = list(sources)
+        self.rowOf = {source: row for row, source in enumerate(self.sources)}
+        self.nodeCount = nodeCount
+        self.predType = np.dtype(predType)
+        self.path = path
+        self.temporary = temporary
+
+        shape = (len(self.sources), nodeCount)
+        if path is None:
+            self.dist = np.empty(shape, dtype=np.float64)
+            self.pred = np.empty(shape, dtype=self.predType)
+        else:
+            self.dist = np.memmap(path, dtype=np.float64, mode=mode, shape=shape)
+            self.pred = np.memmap(path, dtype=self.predType, mode='r+', shape=shape, offset=self.dist.nbytes)
+
+    # Returns (dist, pred) for one of the sources
+    def row(self, source):
+        row = self.rowOf[source]
+        return self.dist[row], self.pred[row]
+
+    def flush(self):
+        if self.path is not None:
+            self.dist.flush()
+            self.pred.flush()
+
+    def close(self):
+        self.flush()
+        self.dist = self.pred = None
+        if self.temporary:
+            os.remove(self.path)
+
+
+# Finished shortest path trees, keyed by source, so going back to an earlier source doesn't run Dijkstra again.
+# Each tree is kept as flat arrays (dist as doubles, pred as edge ids) rather than the lists Dijkstra fills in,
+# and the least recently used trees are dropped once they take up more than maxBytes.
+class ShortestPathTreeCache:
+    def __init__(self, maxBytes=TREE_CACHE_LIMIT):
+        self.memory = MemoryLRU(maxBytes, self.treeSize) # source -> (dist, pred)
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, source):
+        return source in self.memory
+
+    # Returns the cached (dist, pred) for source, or None
+    def get(self, source):
+        tree = self.memory.get(source)
+        if tree is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return tree
+
+    # Stores the tree for source, evicting the least recently used ones if that goes over budget.
+    # Returns the compact (dist, pred) it stored - a tree bigger than the whole budget isn't kept, but still
+    # comes back converted, so callers can always use what put() returns.
+    def put(self, source, dist, pred):
+        tree = (array('d', dist), array('q', pred))
+        self.memory.put(source, tree)
+        return tree
+
+    def discard(self, source):
+        self.memory.discard(source)
+
+    def clear(self):
+        self.memory.clear()
+
+    # Keeps the cached sources that keep(source) is true for
+    def retain(self, keep):
+        for source in self.memory:
+            if not keep(source):
+                self.memory.discard(source)
+
+    @staticmethod
+    def treeSize(source, tree):
+        return sum(part.itemsize * len(part) for part in tree)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.memory),
+                'bytes': self.memory.usedBytes}
+
+
+# Contraction hierarchy over the CSR graph: nodes are contracted one at a time (cheapest first, by edge difference),
+# and whenever removing node v would lose a shortest u -> v -> w path a shortcut u -> w is added. A query then only
+# ever goes "up" the order - forwards from the source and backwards from the destination - so both searches stay
+# tiny, and where they meet is the shortest path. If contraction stops early (CH_CORE_MAX_DEGREE) the nodes left
+# over form a core that shares the top of the order, with all their edges going both up and down, and the
+# searches just do ordinary bidirectional Dijkstra inside it. Edge ids below the original edge count are the graph's own
+# edges; shortcut k - edgeCount is made of the two (possibly shortcut) edges shortcutFirst[k], shortcutSecond[k].
+#
+# save() writes everything to one flat binary file, and load() maps it back in with mmap - nothing is parsed or
+# copied, so opening even a big hierarchy is instant and the pages are shared between processes.
+class ContractionHierarchy:
+    # (name, typecode) of the arrays, in file order
+    ARRAYS = (('upOffsets', 'q'), ('upTargets', 'q'), ('upLengths', 'd'), ('upEdges', 'q'),
+              ('downOffsets', 'q'), ('downSources', 'q'), ('downLengths', 'd'), ('downEdges', 'q'),
+              ('shortcutFirst', 'q'), ('shortcutSecond', 'q'))
+    # magic, then node count, edge count, fingerprint, then the length of each array
+    HEADER = struct.Struct('<8sqq16s' + 'q' * len(ARRAYS))
+
+    def __init__(self, nodeCount, edgeCount, fingerprint, arrays, mapped=None):
+        self.nodeCount = nodeCount
+        self.edgeCount = edgeCount
+        self.fingerprint = fingerprint
+        self.mapped = mapped
+        for (name, typecode), values in zip(self.ARRAYS, arrays):
+            setattr(self, name, values)
+
+    # Identifies the graph a hierarchy was built for, so a stale file is never used for a different one
+    @staticmethod
+    def graphFingerprint(offsets, targets, lengths):
+        digest = hashlib.blake2b(digest_size=16)
+        for part in (offsets, targets, lengths):
+            digest.update(part.tobytes())
+        return digest.digest()
+
+    # Contracts the whole graph. The overlay graph lives in dicts (out[u][w] = (length, edge id), inn the same
+    # the other way round) holding only the shortest of any parallel edges, and shrinks as nodes are contracted.
+    @classmethod
+    def build(cls, offsets, targets, lengths):
+        n = len(offsets) - 1
+        edgeCount = len(targets)
+        out = [{} for i in range(n)]
+        inn = [{} for i in range(n)]
+        for u in range(n):
+            for e in range(offsets[u], offsets[u + 1]):
+                w = targets[e]
+                if w != u and (w not in out[u] or lengths[e] < out[u][w][0]):
+                    out[u][w] = inn[w][u] = (lengths[e], e)
+
+        hierarchy = cls(n, edgeCount, cls.graphFingerprint(offsets, targets, lengths),
+                        [array(typecode) for name, typecode in cls.ARRAYS])
+        contractedNeighbors = [0] * n
+        levels = [0] * n
+        queue = [(hierarchy.contractionPriority(v, hierarchy.shortcutCandidates(v, out, inn), out, inn,
+                                                contractedNeighbors, levels), v) for v in range(n)]
+        heapq.heapify(queue)
+        up = [None] * n
+        down = [None] * n
+        remaining = n
+        overlayEdges = sum(len(edges) for edges in out)
+        while queue and (overlayEdges <= CH_CORE_MAX_DEGREE * remaining or remaining <= CH_CORE_MIN_NODES):
+            priority, v = heapq.heappop(queue)
+            # lazy updates: priorities go stale as neighbours get contracted, so recheck before committing to v
+            candidates = hierarchy.shortcutCandidates(v, out, inn)
+            priority = hierarchy.contractionPriority(v, candidates, out, inn, contractedNeighbors, levels)
+            if queue and priority > queue[0][0]:
+                heapq.heappush(queue, (priority, v))
+                continue
+
+            # everything still attached to v is higher up the order - those edges are v's part of the hierarchy
+            up[v] = list(out[v].items())
+            down[v] = list(inn[v].items())
+            for u, w, length, first, second in candidates:
+                overlayEdges += w not in out[u]
+                out[u][w] = inn[w][u] = (length, hierarchy.edgeCount + len(hierarchy.shortcutFirst))
+                hierarchy.shortcutFirst.append(first)
+                hierarchy.shortcutSecond.append(second)
+            for w in out[v]:
+                del inn[w][v]
+                contractedNeighbors[w] += 1
+                levels[w] = max(levels[w], levels[v] + 1)
+            for u in inn[v]:
+                del out[u][v]
+                contractedNeighbors[u] += 1
+                levels[u] = max(levels[u], levels[v] + 1)
+            overlayEdges -= len(out[v]) + len(inn[v])
+            remaining -= 1
+            out[v] = inn[v] = None
+
+        # whatever's left is the core: every edge still in the overlay belongs to both searches
+        for priority, v in queue:
+            up[v] = list(out[v].items())
+            down[v] = list(inn[v].items())
+
+        hierarchy.upOffsets.append(0)
+        hierarchy.downOffsets.append(0)
+        for v in range(n):
+            for w, (length, e) in up[v]:
+                hierarchy.upTargets.append(w)
+                hierarchy.upLengths.append(length)
+                hierarchy.upEdges.append(e)
+            hierarchy.upOffsets.append(len(hierarchy.upTargets))
+            for u, (length, e) in down[v]:
+                hierarchy.downSources.append(u)
+                hierarchy.downLengths.append(length)
+                hierarchy.downEdges.append(e)
+            hierarchy.downOffsets.append(len(hierarchy.downSources))
+        return hierarchy
+
+    # Node priority, lowest contracted first: twice the shortcuts needed, minus the edges removed, plus neighbours
+    # already contracted and how many levels of contracted nodes sit below v (both of which spread the contraction
+    # out evenly instead of eating one region first, which is what keeps the upward searches small)
+    def contractionPriority(self, v, candidates, out, inn, contractedNeighbors, levels):
+        return 2 * len(candidates) - len(out[v]) - len(inn[v]) + contractedNeighbors[v] + levels[v]
+
+    # Every u -> v -> w through v with no path from u to w at least as short that avoids v, as
+    # (u, w, length, u -> v edge id, v -> w edge id). The witness search gives up after WITNESS_SETTLE_LIMIT nodes,
+    # which can only add shortcuts that weren't needed, never leave out one that was.
+    def shortcutCandidates(self, v, out, inn):
+        candidates = []
+        for u, (inLength, first) in inn[v].items():
+            targets = {w: inLength + outLength for w, (outLength, second) in out[v].items() if w != u}
+            if not targets:
+                continue
+            witness = self.witnessSearch(u, v, max(targets.values()), out)
+            for w, length in targets.items():
+                if witness.get(w, float('inf')) > length and (w not in out[u] or out[u][w][0] > length):
+                    candidates.append((u, w, length, first, out[v][w][1]))
+        return candidates
+
+    # Dijkstra from u in the overlay graph without going through v, up to distance limit
+    def witnessSearch(self, u, v, limit, out):
+        dist = {u: 0}
+        queue = [(0, u)]
+        settled = 0
+        while queue and settled < WITNESS_SETTLE_LIMIT:
+            du, x = heapq.heappop(queue)
+            if du > dist[x]:
+                continue
+            if du > limit:
+                break
+            settled += 1
+            for y, (length, e) in out[x].items():
+                if y != v and du + length < dist.get(y, float('inf')):
+                    dist[y] = du + length
+                    heapq.heappush(queue, (du + length, y))
+        return dist
+
+    # Shortest path from src to dest, as edge ids of the original graph from dest back to src (None if dest
+    # can't be reached). The two upward searches are a few hundred nodes at most, so they use dicts and heapq
+    # rather than anything sized to the whole graph.
+    def query(self, src, dest):
+        up = (self.upOffsets, self.upTargets, self.upLengths, self.upEdges)
+        down = (self.downOffsets, self.downSources, self.downLengths, self.downEdges)
+        # (edges to search along, edges to check for stalling) for the forward and backward search
+        searches = ((up, down), (down, up))
+        dists = ({src: 0}, {dest: 0})
+        preds = ({}, {})
+        queues = ([(0, src)], [(0, dest)])
+        best = float('inf') if src != dest else 0
+        meet = src
+        while queues[0] or queues[1]:
+            # the side with the smaller key goes next; a side whose key has reached best can't improve on it
+            side = 0 if queues[0] and (not queues[1] or queues[0][0][0] <= queues[1][0][0]) else 1
+            if queues[side][0][0] >= best:
+                break
+            (offsets, nodes, lengths, edges), (stallOffsets, stallNodes, stallLengths, stallEdges) = searches[side]
+            dist, pred, queue = dists[side], preds[side], queues[side]
+            du, x = heapq.heappop(queue)
+            if du > dist[x]:
+                continue
+            other = dists[1 - side].get(x)
+            if other is not None and du + other < best:
+                best = du + other
+                meet = x
+
+            # stall-on-demand: if some higher node already reached gets to x for less than du, x's label isn't its
+            # real distance and nothing found through it can be on a shortest path - don't search on from it
+            stalled = False
+            for i in range(stallOffsets[x], stallOffsets[x + 1]):
+                if dist.get(stallNodes[i], du) + stallLengths[i] < du:
+                    stalled = True
+                    break
+            if stalled:
+                continue
+
+            for i in range(offsets[x], offsets[x + 1]):
+                y = nodes[i]
+                if du + lengths[i] < dist.get(y, float('inf')):
+                    dist[y] = du + lengths[i]
+                    pred[y] = (x, edges[i])
+                    heapq.heappush(queue, (du + lengths[i], y))
+
+        if METRICS.enabled:
+            METRICS.count('routing.ch_nodes_reached', len(dists[0]) + len(dists[1]))
+        if best == float('inf'):
+            return None
+        # src ... meet forwards, then meet ... dest backwards
+        forward = []
+        node = meet
+        while node in preds[0]:
+            node, e = preds[0][node]
+            forward.append(e)
+        backward = []
+        node = meet
+        while node in preds[1]:
+            node, e = preds[1][node]
+            backward.append(e)
+
+        edgeIds = []
+        for e in reversed(backward):
+            edgeIds.extend(reversed(self.unpack(e)))
+        for e in forward:
+            edgeIds.extend(reversed(self.unpack(e)))
+        return edgeIds
+
+    # The original edge ids a (possibly shortcut) edge stands for, in src -> dest order
+    def unpack(self, e):
+        edgeIds = []
+        stack = [e]
+        while stack:
+            e = stack.pop()
+            if e < self.edgeCount:
+                edgeIds.append(e)
+            else:
+                stack.append(self.shortcutSecond[e - self.edgeCount])
+                stack.append(self.shortcutFirst[e - self.edgeCount])
+        return edgeIds
+
+    def save(self, path):
+        arrays = [getattr(self, name) for name, typecode in self.ARRAYS]
+        with open(path, 'wb') as f:
+            f.write(self.HEADER.pack(CH_MAGIC, self.nodeCount, self.edgeCount, self.fingerprint,
+                                     *[len(values) for values in arrays]))
+            for values in arrays:
+                f.write(values.tobytes())
+
+    # Maps a saved hierarchy back in. The arrays are memoryviews straight onto the file.
+    # Raises ValueError for anything that isn't a complete hierarchy file (wrong magic, truncated, padded).
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            header = cls.HEADER.unpack_from(mapped)
+        except struct.error:
+            mapped.close()
+            raise ValueError('{} is too short for a contraction hierarchy header'.format(path))
+        if header[0] != CH_MAGIC:
+            mapped.close()
+            raise ValueError('{} is not a contraction hierarchy file'.format(path))
+        counts = dict(zip((name for name, typecode in cls.ARRAYS), header[4:]))
+        expected = cls.HEADER.size + sum(count * array(typecode).itemsize
+                                         for (name, typecode), count in zip(cls.ARRAYS, header[4:]))
+        if (min(header[4:]) < 0 or len(mapped) != expected or counts['upOffsets'] != header[1] + 1
+                or counts['downOffsets'] != header[1] + 1):
+            mapped.close()
+            raise ValueError('{} is truncated or damaged - its size doesn\'t match its header'.format(path))
+
+        view = memoryview(mapped)
+        arrays = []
+        start = cls.HEADER.size
+        for (name, typecode), count in zip(cls.ARRAYS, header[4:]):
+            size = count * array(typecode).itemsize
+            arrays.append(view[start:start + size].cast(typecode))
+            start += size
+        return cls(header[1], header[2], header[3], arrays, mapped)
+
+    def close(self):
+        if self.mapped is not None:
+            for name, typecode in self.ARRAYS:
+                getattr(self, name).release()
+            self.mapped.close()
+            self.mapped = None
 
 
 class NetworkRoutingSolver:
-    def __init__( self, display ):
-        pass
+    # cacheBytes is the memory budget for the shortest path trees kept from earlier sources (see treeFor)
+    def __init__( self, display, cacheBytes=TREE_CACHE_LIMIT ):
+        self.treeCache = ShortestPathTreeCache(cacheBytes)
+        self.arrayCSR = None
+        self.batch = None
+        self.hierarchy = None
 
-    def initializeNetwork( self, network ):
+    # Flattens the graph into CSR form once, so the searches only ever touch flat arrays:
+    # node u's edges are edge ids offsets[u] to offsets[u+1]-1, going to targets[e] with lengths[e].
+    # edges[e] keeps the CS312GraphEdge for building the path getShortestPath hands back to the GUI.
+    # contract=True also builds a ContractionHierarchy for getShortestPathBetween(..., method=P2P_CH). With
+    # hierarchyPath it's loaded from that file if the file was saved for this same graph, and otherwise built and
+    # saved there for next time. On graphs without geometric structure (like the GUI's random networks) the build
+    # takes minutes and the queries come out slower than P2P_BIDIRECTIONAL, so it's off by default.
+    def initializeNetwork( self, network, contract=False, hierarchyPath=None ):
         assert( type(network) == CS312Graph )
         self.network = network
 
+        self.offsets = array('q', [0])
+        self.targets = array('q')
+        self.lengths = array('d')
+        self.edges = []
+        for node in network.nodes:
+            for edge in node.neighbors:
+                self.targets.append(edge.dest.node_id)
+                self.lengths.append(edge.length)
+                self.edges.append(edge)
+            self.offsets.append(len(self.edges))
+        # pathEdges[e] is edge e as the GUI draws it, built the first time a path goes through it
+        self.pathEdges = [None] * len(self.edges)
+
+        # Per-query state: distance to every node and the edge id it was reached by (NO_EDGE if it wasn't)
+        self.dist = []
+        self.pred = []
+        if self.batch is not None:
+            self.batch.close()
+            self.batch = None
+        self.treeCache.clear()
+        # Built the first time a point-to-point query needs them (see reverseGraph/heuristicCoordinates)
+        self.reverse = None
+        self.reversePositions = None
+        self.coordinates = None
+        # Built the first time dijkstraArray runs (see arrayGraph)
+        self.arrayCSR = None
+
+        if self.hierarchy is not None:
+            self.hierarchy.close()
+            self.hierarchy = None
+        if contract or hierarchyPath is not None:
+            self.hierarchy = self.loadHierarchy(hierarchyPath)
+
+    # Loads the contraction hierarchy at path if it matches the graph, otherwise builds one (and saves it to path)
+    def loadHierarchy( self, path=None ):
+        fingerprint = ContractionHierarchy.graphFingerprint(self.offsets, self.targets, self.lengths)
+        if path is not None and os.path.exists(path):
+            try:
+                hierarchy = ContractionHierarchy.load(path)
+            except ValueError:
+                hierarchy = None
+            if hierarchy is not None and hierarchy.fingerprint == fingerprint:
+                return hierarchy
+            if hierarchy is not None:
+                hierarchy.close()
+
+        hierarchy = ContractionHierarchy.build(self.offsets, self.targets, self.lengths)
+        if path is not None:
+            hierarchy.save(path)
+        return hierarchy
+
     # This one just picks out the shortest past from src->dest within your MST
-    def getShortestPath( self, destIndex ):
+    # With srcIndex it uses that source's tree instead: its row of the last computeShortestPathsBatch if it has one,
+    # otherwise the cached tree (see treeFor), so asking about earlier sources again doesn't rerun Dijkstra
+    def getShortestPath( self, destIndex, srcIndex=None ):
         self.dest = destIndex
+        if METRICS.enabled:
+            METRICS.count('routing.path_queries')
+        if srcIndex is None:
+            pred = self.pred
+        elif self.batch is not None and srcIndex in self.batch.rowOf:
+            pred = self.batch.row(srcIndex)[1]
+        else:
+            pred = self.treeFor(srcIndex)[1]
+
+        # Check if there really was a path found - if not, it's probably unreachable
+        if pred[destIndex] == NO_EDGE:
+            return {'cost': float('inf'), 'path': []}
+        return self.makePath(self.tracePred(pred, destIndex))
 
+    # Turns edge ids (from the destination back to the source) into the {'cost', 'path'} dict the GUI draws
+    def makePath( self, edgeIds ):
         path_edges = []
         total_length = 0
+        pathEdges = self.pathEdges
+        for e in edgeIds:
+            if pathEdges[e] is None:
+                currEdge = self.edges[e]
+                pathEdges[e] = (currEdge.src.loc, currEdge.dest.loc,'{:.0f}'.format(currEdge.length))
+            path_edges.append(pathEdges[e])
+            total_length += self.lengths[e]
+        return {'cost':total_length, 'path':path_edges}
 
-        print("=======================")
-        print(">>NRS: getSP(): nodes size="+str(len(self.network.nodes)))
-        currNode = self.network.nodes[destIndex] #start from the destination node and work backwards
-        print(">>NRS: getSP(): starting on node= " + str(currNode))
-        #edges_left = 3 #this is just set to 3 for the dummy version
+    # (dist, pred) of the shortest path tree from srcIndex - from the cache if it's there, otherwise worked out
+    # with the heap and cached
+    def treeFor( self, srcIndex ):
+        tree = self.treeCache.get(srcIndex)
+        if tree is None:
+            tree = self.treeCache.put(srcIndex, *self.shortestPathTree(srcIndex, True))
+        return tree
 
-        # Check if there really was a path found - if not, it's probably unreachable
-        if currNode.incomingEdge is None:
-            print(">>NRS: getSP(): done, no path found!!")
-            return {'cost': float('inf'), 'path': path_edges}
-
-        # Add up the MST edges starting from final node and going back to start node
-        while currNode.incomingEdge is not None:
-            currEdge = currNode.incomingEdge
-            path_edges.append( (currEdge.src.loc, currEdge.dest.loc,'{:.0f}'.format(currEdge.length)) )
-            total_length += currEdge.length
-            currNode = currEdge.src # back up to the previous node
-
-        print(">>NRS: getSP(): done, #path_edges="+str(len(path_edges)))
-        return {'cost':total_length, 'path':path_edges}
+    # Shortest path for a single src -> dest pair, in the same {'cost', 'path'} form as getShortestPath, without
+    # settling the whole graph: every method stops as soon as the answer is known (see the P2P_ constants).
+    # P2P_CH has to be asked for, even when there's a contraction hierarchy. Doesn't touch self.dist/self.pred.
+    def getShortestPathBetween( self, srcIndex, destIndex, method=P2P_BIDIRECTIONAL ):
+        if srcIndex == destIndex:
+            return {'cost': 0, 'path': []}
+        if method == P2P_CH:
+            if self.hierarchy is None:
+                raise ValueError('No contraction hierarchy - initializeNetwork with contract=True first')
+            edgeIds = self.hierarchy.query(srcIndex, destIndex)
+        elif method == P2P_DIJKSTRA:
+            edgeIds = self.pointToPointDijkstra(srcIndex, destIndex)
+        elif method == P2P_BIDIRECTIONAL:
+            edgeIds = self.bidirectionalDijkstra(srcIndex, destIndex)
+        elif method == P2P_ASTAR:
+            edgeIds = self.aStar(srcIndex, destIndex)
+        else:
+            raise ValueError('Unknown point-to-point method: {}'.format(method))
+        if edgeIds is None:
+            return {'cost': float('inf'), 'path': []}
+        return self.makePath(edgeIds)
+
+    # Follows pred back from node to wherever it runs out, returning the edge ids on the way
+    def tracePred( self, pred, node ):
+        edgeIds = []
+        while pred[node] != NO_EDGE:
+            edgeIds.append(pred[node])
+            node = self.edges[pred[node]].src.node_id
+        return edgeIds
+
+    def pointToPointDijkstra( self, srcIndex, destIndex ):
+        return self.aStar(srcIndex, destIndex, heuristic=False)
+
+    # A* from srcIndex, ordered by dist + h where h is the straight line distance to destIndex times the smallest
+    # length/straight line ratio of any edge. That makes h a lower bound on every edge, so it's consistent and
+    # the first time destIndex comes off the heap its distance is final. heuristic=False is plain Dijkstra.
+    # Returns the path's edge ids (dest back to src), or None if destIndex can't be reached.
+    def aStar( self, srcIndex, destIndex, heuristic=True ):
+        offsets = self.offsets
+        targets = self.targets
+        lengths = self.lengths
+        n = len(offsets) - 1
+
+        if heuristic:
+            xs, ys, scale = self.heuristicCoordinates()
+            destX = xs[destIndex]
+            destY = ys[destIndex]
+            h = lambda v: scale * math.hypot(xs[v] - destX, ys[v] - destY)
+        else:
+            h = None
+
+        dist = [float('inf')] * n
+        dist[srcIndex] = 0
+        pred = [NO_EDGE] * n
+        estimate = [0.0] * n  # dist + h, what the heap orders by
+        settled = [False] * n
+        estimate[srcIndex] = h(srcIndex) if h else 0.0
+        priorityQueue = makeHeap(estimate)
+        priorityQueue.push(srcIndex)
+        while len(priorityQueue) > 0:
+            u = priorityQueue.popMin()
+            if u == destIndex:
+                if METRICS.enabled:
+                    countRelaxations(offsets, settled)
+                return self.tracePred(pred, destIndex)
+            settled[u] = True
+            du = dist[u]
+            for e in range(offsets[u], offsets[u + 1]):
+                v = targets[e]
+                newDist = du + lengths[e]
+                if not settled[v] and newDist < dist[v]:
+                    dist[v] = newDist
+                    pred[v] = e
+                    estimate[v] = newDist + h(v) if h else newDist
+                    if v in priorityQueue:
+                        priorityQueue.decreaseKey(v)
+                    else:
+                        priorityQueue.push(v)
+        if METRICS.enabled:
+            countRelaxations(offsets, settled)
+        return None
+
+    # Dijkstra forwards from srcIndex and backwards (over the reversed edges) from destIndex, always advancing
+    # whichever side has the smaller key on top. best tracks the shortest src -> dest path through any edge both
+    # sides have reached; once the two heap tops add up to at least that, nothing shorter is left.
+    # Returns the path's edge ids (dest back to src), or None if destIndex can't be reached.
+    def bidirectionalDijkstra( self, srcIndex, destIndex ):
+        n = len(self.offsets) - 1
+        sides = ((self.offsets, self.targets, self.lengths, None),) + (self.reverseGraph(),)
+        dists = ([float('inf')] * n, [float('inf')] * n)
+        dists[0][srcIndex] = 0
+        dists[1][destIndex] = 0
+        preds = ([NO_EDGE] * n, [NO_EDGE] * n)
+        keys = ([0.0] * n, [0.0] * n)
+        settled = ([False] * n, [False] * n)
+        queues = (makeHeap(keys[0]), makeHeap(keys[1]))
+        queues[0].push(srcIndex)
+        queues[1].push(destIndex)
+
+        best = float('inf')
+        meet = None
+        while len(queues[0]) > 0 and len(queues[1]) > 0:
+            topKeys = (keys[0][queues[0].peek()], keys[1][queues[1].peek()])
+            if topKeys[0] + topKeys[1] >= best:
+                break
+            side = 0 if topKeys[0] <= topKeys[1] else 1
+            offsets, targets, lengths, edgeIds = sides[side]
+            dist, otherDist = dists[side], dists[1 - side]
+            pred, queue = preds[side], queues[side]
+
+            u = queue.popMin()
+            settled[side][u] = True
+            du = dist[u]
+            for e in range(offsets[u], offsets[u + 1]):
+                v = targets[e]
+                newDist = du + lengths[e]
+                if newDist + otherDist[v] < best:
+                    best = newDist + otherDist[v]
+                    meet = (side, u, v, e if edgeIds is None else edgeIds[e])
+                if not settled[side][v] and newDist < dist[v]:
+                    dist[v] = newDist
+                    pred[v] = e if edgeIds is None else edgeIds[e]
+                    keys[side][v] = newDist
+                    if v in queue:
+                        queue.decreaseKey(v)
+                    else:
+                        queue.push(v)
+
+        if METRICS.enabled:
+            countRelaxations(sides[0][0], settled[0])
+            countRelaxations(sides[1][0], settled[1])
+        if meet is None:
+            return None
+        # the meeting edge goes u -> v in the direction of its side's search
+        side, u, v, e = meet
+        forwardEnd, backwardStart = (u, v) if side == 0 else (v, u)
+        # backward preds point at edges leaving a node towards dest, so walk them from the meeting point forwards
+        edgeIds = []
+        node = backwardStart
+        while preds[1][node] != NO_EDGE:
+            edgeIds.append(preds[1][node])
+            node = self.edges[preds[1][node]].dest.node_id
+        edgeIds.reverse()
+        return edgeIds + [e] + self.tracePred(preds[0], forwardEnd)
+
+    # The reversed graph in CSR form, as (offsets, targets, lengths, edge ids): reversed edge r goes from
+    # edges[edgeIds[r]]'s dest to its src
+    def reverseGraph( self ):
+        if self.reverse is None:
+            n = len(self.offsets) - 1
+            incoming = [[] for i in range(n)]
+            for u in range(n):
+                for e in range(self.offsets[u], self.offsets[u + 1]):
+                    incoming[self.targets[e]].append(e)
+
+            offsets = array('q', [0])
+            targets = array('q')
+            lengths = array('d')
+            edgeIds = array('q')
+            for v in range(n):
+                for e in incoming[v]:
+                    targets.append(self.edges[e].src.node_id)
+                    lengths.append(self.lengths[e])
+                    edgeIds.append(e)
+                offsets.append(len(targets))
+            self.reverse = (offsets, targets, lengths, edgeIds)
+            # where each edge ended up, so setLength can keep the reversed lengths in step
+            self.reversePositions = [0] * len(edgeIds)
+            for r, e in enumerate(edgeIds):
+                self.reversePositions[e] = r
+        return self.reverse
+
+    # (node x's, node y's, scale) for the A* heuristic: scale is the smallest edge length / straight line
+    # distance ratio, so scale * straight line distance never overestimates (0 if there's nothing to go on).
+    # It's shaved by a hair so rounding in hypot can't push the estimate over an edge's length either.
+    def heuristicCoordinates( self ):
+        if self.coordinates is None:
+            xs = [node.loc.x() for node in self.network.nodes]
+            ys = [node.loc.y() for node in self.network.nodes]
+            scale = float('inf')
+            for u in range(len(xs)):
+                for e in range(self.offsets[u], self.offsets[u + 1]):
+                    v = self.targets[e]
+                    straight = math.hypot(xs[u] - xs[v], ys[u] - ys[v])
+                    if straight > 0:
+                        scale = min(scale, self.lengths[e] / straight)
+            self.coordinates = (xs, ys, scale * (1 - 2.0 ** -40) if scale != float('inf') else 0.0)
+        return self.coordinates
 
     # If "use both" was checked in the GUI, then this fn will be called 2x,
     # once with use_heap = True and once with use_heap = False
-    # This one runs all of Dijkstra's and creates an MST
+    # This one runs all of Dijkstra's and fills in dist/pred - nothing on the graph itself changes,
+    # so back to back queries don't need any resetting
+    @captured('computeShortestPaths')
     def computeShortestPaths( self, srcIndex, use_heap ):
-        print("=======================")
-        print(">>NRS: computeSP(): starting, useHeap="+str(use_heap))
-
         self.source = srcIndex
-        startNode = self.network.nodes[srcIndex]
-        startNode.distance = 0; #init the first node
-
         t1 = time.time()
-
-        if not use_heap:   # USE UNSORTED ARRAY
-            priorityQueue = self.makeQueue()
-
-            while len(priorityQueue) > 0:
-                #get first node out of queue
-                min = self.getMinNode(priorityQueue, None, use_heap) #unsortedArr doesn't use the dictionary
-                priorityQueue.remove(min)
-
-                # get min's neighbors and organize them by length
-                for edge in min.neighbors:
-                    if (min.distance + edge.length) < edge.dest.distance:  #save new dist as the smallest dist
-                        edge.dest.incomingEdge = edge #link destNode to its previous edge so we can do getShortestPath()
-                        edge.dest.distance = min.distance + edge.length #update the destNode's new shortest dist
-
-        else:  # USE MINHEAP
-            priorityQueue = [startNode, startNode] #doing this twice so there will always be a 0 on top to make dist compares easy
-            nodeToIndexDict = {}
-
-
-            while len(priorityQueue) > 1:  # while there are still nodes in the pQueue (minHeap will always have 1 head node)
-                # get first node out of queue
-                min = self.getMinNode(priorityQueue, nodeToIndexDict, use_heap)
-
-                # get min's neighbors and organize them by length
-                for edge in min.neighbors:
-                    if (min.distance + edge.length) < edge.dest.distance:  # if the dist from currNode -> destNode, save new dist as the smallest dist
-                        edge.dest.incomingEdge = edge
-                        edge.dest.distance = min.distance + edge.length  # update the destNode's new shortest dist
-                        #Check if the destNode is not already in the dictionary
-                        heapIndex = 0
-                        if edge.dest.node_id not in nodeToIndexDict:
-                            # if node doesn't exist in dictionary already, add it to heap AND dictionary
-                            heapIndex = len(priorityQueue)
-                            nodeToIndexDict[edge.dest.node_id] = heapIndex
-                            priorityQueue.append(edge.dest)
-                        else: #the node is already in the dictionary
-                            heapIndex = nodeToIndexDict.get(edge.dest.node_id)
-                        # Resort the pQueue so smallest is at top
-                        self.bubbleUp(priorityQueue, nodeToIndexDict, heapIndex)
-
+        dist, pred = self.shortestPathTree(srcIndex, use_heap)
         t2 = time.time()
+        # the tree is also cached, so getShortestPath(dest, srcIndex) can come back to it after other sources
+        self.dist, self.pred = self.treeCache.put(srcIndex, dist, pred)
         return (t2-t1)
 
+    # Runs Dijkstra from srcIndex over the CSR arrays alone and returns (dist, pred)
+    def shortestPathTree( self, srcIndex, use_heap ):
+        n = len(self.offsets) - 1
+        dist = [float('inf')] * n
+        pred = [NO_EDGE] * n
+        dist[srcIndex] = 0
+        if use_heap:
+            self.dijkstraHeap(srcIndex, dist, pred)
+        else:
+            self.dijkstraArray(srcIndex, dist, pred)
+        return dist, pred
 
-    # initializes the pQueue by setting each node's value to infinity and setting the start node's distance to 0
-    def makeQueue(self):
-        #priorityQueue = list() #this can be a regular array or a min heap
-        priorityQueue = list(self.network.nodes)
-        priorityQueue[self.source].distance = 0 # this is the equivalent of setting node A's dist column to 0
+    # Shortest path trees from every node in sources (or 'all' of them) in one go, as a ShortestPathMatrix -
+    # which also becomes self.batch, for getShortestPath(dest, src).
+    # With workers > 1 the sources are split over a process pool. The CSR arrays go to the workers once through
+    # shared memory, and each Dijkstra is independent, so nothing is shared while they run. A matrix bigger than
+    # memoryLimit bytes goes to a memory-mapped file (at path, or a temporary one), which the workers write into.
+    def computeShortestPathsBatch( self, sources='all', use_heap=True, workers=1, path=None,
+                                   memoryLimit=BATCH_MEMORY_LIMIT ):
+        n = len(self.offsets) - 1
+        sources = range(n) if isinstance(sources, str) and sources == 'all' else sources
+        predType = np.int32 if len(self.targets) < 2 ** 31 else np.int64
+        temporary = False
+        if path is None and len(sources) * n * (8 + np.dtype(predType).itemsize) > memoryLimit:
+            fd, path = tempfile.mkstemp(suffix='.spm')
+            os.close(fd)
+            temporary = True
+        if self.batch is not None:
+            self.batch.close()
+        matrix = ShortestPathMatrix(sources, n, predType, path, temporary)
+        self.batch = matrix
 
-        return priorityQueue
+        if workers is not None and workers <= 1:
+            for row, source in enumerate(matrix.sources):
+                matrix.dist[row], matrix.pred[row] = self.shortestPathTree(source, use_heap)
+            matrix.flush()
+            return matrix
 
-    #searches through the pQueue and finds the node with the minimum length, returns its index
-    def getMinNode(self, pQueue, dict, use_heap):
+        workers = workers or os.cpu_count() or 1
+        csr = (self.offsets, self.targets, self.lengths)
+        shm = SharedMemory(create=True, size=max(sum(part.itemsize * len(part) for part in csr), 1))
+        try:
+            start = 0
+            for part in csr:
+                size = part.itemsize * len(part)
+                shm.buf[start:start + size] = part.tobytes()
+                start += size
 
-        if use_heap:
-            #this branch gets the min node AND deletes it from the pQueue
-            #Checking right here if the left child is smaller than right child - picks the min from those
-            minHeapID = 1
-            if len(pQueue) >= 3: #it'll only have 2 children to choose from if it has 3+ nodes
-                if pQueue[1].distance < pQueue[2].distance:
-                    minHeapID = 1
-                else:
-                    minHeapID = 2
-
-            min = pQueue[minHeapID]  # we're not doing 0 because we're keeping a permanent "0" head on this minheap
-            pQueue[minHeapID] = pQueue[len(pQueue)-1]
-            pQueue.pop()  # take off the top node since it's the smallest
-            self.bubbleDown(pQueue, dict, minHeapID)
-            return min
+            # a few chunks per worker, so one slow chunk doesn't leave the rest idle at the end
+            rows = range(len(matrix.sources))
+            chunkSize = max(1, len(rows) // (workers * 4))
+            with ProcessPoolExecutor(max_workers=workers, initializer=_initBatchWorker,
+                                     initargs=(shm.name, n, len(self.targets), use_heap, matrix.sources,
+                                               predType, path)) as pool:
+                tasks = [pool.submit(_batchChunk, rows[lo:lo + chunkSize]) for lo in range(0, len(rows), chunkSize)]
+                for task in as_completed(tasks):
+                    for row, dist, pred in task.result():  # empty when the worker wrote to the file itself
+                        matrix.dist[row] = dist
+                        matrix.pred[row] = pred
+        finally:
+            shm.close()
+            shm.unlink()
+        matrix.flush()
+        return matrix
 
+    # Dijkstra with the indexed heap: every node is pushed once and then only ever decreased, O((V + E) log V)
+    def dijkstraHeap( self, srcIndex, dist, pred ):
+        offsets = self.offsets
+        targets = self.targets
+        lengths = self.lengths
+
+        settled = [False] * len(dist)
+        priorityQueue = makeHeap(dist)
+        priorityQueue.push(srcIndex)
+        while len(priorityQueue) > 0:
+            u = priorityQueue.popMin()
+            settled[u] = True
+            du = dist[u]
+            for e in range(offsets[u], offsets[u + 1]):
+                v = targets[e]
+                newDist = du + lengths[e]
+                if newDist < dist[v] and not settled[v]:
+                    dist[v] = newDist
+                    pred[v] = e
+                    if v in priorityQueue:
+                        priorityQueue.decreaseKey(v)
+                    else:
+                        priorityQueue.push(v)
+        if METRICS.enabled:
+            countRelaxations(offsets, settled)
+
+    # Dijkstra with an array instead of a heap, still O(V^2) but with NumPy doing the work: keys is dist with every
+    # settled node masked out to inf, so argmin over it picks the next node to settle, and that node's whole
+    # adjacency row is relaxed with a handful of vector operations instead of an edge at a time.
+    # Fills in the same dist/pred lists as dijkstraHeap.
+    def dijkstraArray( self, srcIndex, dist, pred ):
+        offsets, targets, lengths, edgeIds = self.arrayGraph()
+
+        keys = np.array(dist, dtype=np.float64)
+        distances = keys.copy()
+        preds = np.full(len(dist), NO_EDGE, dtype=np.int64)
+        settledCount = 0
+        relaxations = 0
+        while True:
+            u = int(keys.argmin())
+            du = keys[u]
+            if du == np.inf:
+                break # everything left is unreachable
+            keys[u] = np.inf
+            settledCount += 1
+
+            lo = offsets[u]
+            hi = offsets[u + 1]
+            if lo == hi:
+                continue
+            relaxations += hi - lo
+            row = targets[lo:hi]
+            newDist = du + lengths[lo:hi]
+            # a settled node is never improved on (its dist is at most du), so this only ever updates unsettled ones
+            better = newDist < distances[row]
+            if better.any():
+                row = row[better]
+                newDist = newDist[better]
+                distances[row] = newDist
+                keys[row] = newDist
+                preds[row] = edgeIds[lo:hi][better]
+
+        dist[:] = distances.tolist()
+        pred[:] = preds.tolist()
+        if METRICS.enabled:
+            METRICS.count('routing.array_min_scans', settledCount)
+            METRICS.count('routing.edge_relaxations', relaxations)
+
+    # The CSR arrays as NumPy arrays for dijkstraArray, as (offsets as a list, targets, lengths, edge ids).
+    # Parallel edges are cut down to the shortest one, so no row has the same target twice - relaxing a row
+    # assigns to all of its targets at once, and with a repeated target whichever edge came last would win.
+    def arrayGraph( self ):
+        if self.arrayCSR is None:
+            n = len(self.offsets) - 1
+            offsets = np.array(self.offsets, dtype=np.int64)
+            targets = np.array(self.targets, dtype=np.int64)
+            lengths = np.array(self.lengths, dtype=np.float64)
+            edgeIds = np.arange(len(targets), dtype=np.int64)
+
+            sources = np.repeat(np.arange(n, dtype=np.int64), np.diff(offsets))
+            pairs = sources * n + targets
+            sortedPairs = np.sort(pairs)
+            if len(pairs) > 1 and (sortedPairs[1:] == sortedPairs[:-1]).any():
+                # sort by length, then (stably) by source and target, and keep the first edge of every run
+                order = np.argsort(lengths, kind='stable')
+                order = order[np.argsort(pairs[order], kind='stable')]
+                keep = np.ones(len(order), dtype=bool)
+                keep[1:] = pairs[order[1:]] != pairs[order[:-1]]
+                edgeIds = order[keep]
+                offsets = np.searchsorted(sources[edgeIds], np.arange(n + 1))
+                targets = targets[edgeIds]
+                lengths = lengths[edgeIds]
+            self.arrayCSR = (offsets.tolist(), targets, lengths, edgeIds)
+        return self.arrayCSR
+
+
+    # ---- Dynamic updates ----
+    # Edges of the loaded graph can be changed in place. Edge ids stay put for updates and deletes (a deleted edge
+    # stays in the CSR arrays with an infinite length, which no search ever relaxes), and only an insert moves
+    # anything: the new edge goes at the end of its source's row, and every later edge id goes up by one.
+    # After each change the current shortest path tree (the last computeShortestPaths) is repaired in place,
+    # touching only the nodes whose distance can have changed (Ramalingam & Reps), so getShortestPath is right
+    # straight away. The trees cached for other sources, the batch matrix and the contraction hierarchy can't be
+    # repaired that cheaply and are dropped. Each method returns how many nodes the repair had to look at.
+
+    # Sets the length of the edge srcIndex -> destIndex (the first one, if there are parallel edges)
+    def updateEdge( self, srcIndex, destIndex, length ):
+        self.checkLength(length)
+        e = self.findEdge(srcIndex, destIndex)
+        oldLength = self.lengths[e]
+        if length == oldLength:
+            return 0
+        self.setLength(e, length)
+        self.edges[e].length = length
+        self.pathEdges[e] = None
+        self.graphChanged(e, length < oldLength)
+        if length < oldLength:
+            return self.repairDecrease(e)
+        return self.repairIncrease(e)
+
+    # Adds an edge srcIndex -> destIndex to the graph and returns its edge id
+    def insertEdge( self, srcIndex, destIndex, length ):
+        self.checkLength(length)
+        srcNode = self.network.nodes[srcIndex]
+        srcNode.addEdge(self.network.nodes[destIndex], length)
+        e = self.offsets[srcIndex + 1]
+        self.targets.insert(e, destIndex)
+        self.lengths.insert(e, length)
+        self.edges.insert(e, srcNode.neighbors[-1])
+        self.pathEdges.insert(e, None)
+        np.frombuffer(self.offsets, dtype=np.int64)[srcIndex + 1:] += 1
+        if len(self.pred) > 0:
+            pred = np.frombuffer(self.pred, dtype=np.int64)
+            pred[pred >= e] += 1
+
+        # everything built from the edge ids is out of date
+        self.reverse = None
+        self.reversePositions = None
+        self.graphChanged(e, True)
+        self.repairDecrease(e)
+        return e
+
+    # Removes the edge srcIndex -> destIndex (the first one, if there are parallel edges) from the graph
+    def deleteEdge( self, srcIndex, destIndex ):
+        e = self.findEdge(srcIndex, destIndex)
+        self.network.nodes[srcIndex].neighbors.remove(self.edges[e])
+        self.setLength(e, float('inf'))
+        self.graphChanged(e, False)
+        return self.repairIncrease(e)
+
+    def checkLength( self, length ):
+        if not 0 <= length < float('inf'):
+            raise ValueError('Edge lengths must be finite and non-negative, not {}'.format(length))
+
+    # Edge id of the first edge srcIndex -> destIndex that hasn't been deleted
+    def findEdge( self, srcIndex, destIndex ):
+        for e in range(self.offsets[srcIndex], self.offsets[srcIndex + 1]):
+            if self.targets[e] == destIndex and self.lengths[e] != float('inf'):
+                return e
+        raise ValueError('No edge from {} to {}'.format(srcIndex, destIndex))
+
+    # Changes the length of edge e everywhere it's stored
+    def setLength( self, e, length ):
+        self.lengths[e] = length
+        if self.reverse is not None:
+            self.reverse[2][self.reversePositions[e]] = length
+
+    # Drops whatever can't be kept up to date across a change to edge e. decreased is true when e got shorter
+    # (or is new), which is the only way the A* heuristic can stop being a lower bound.
+    def graphChanged( self, e, decreased ):
+        self.arrayCSR = None
+        if self.hierarchy is not None:
+            self.hierarchy.close()
+            self.hierarchy = None
+        if self.batch is not None:
+            self.batch.close()
+            self.batch = None
+        self.treeCache.retain(lambda source: len(self.pred) != 0 and source == self.source)
+
+        if decreased and self.coordinates is not None:
+            xs, ys, scale = self.coordinates
+            u = self.edges[e].src.node_id
+            v = self.targets[e]
+            straight = math.hypot(xs[u] - xs[v], ys[u] - ys[v])
+            if straight > 0:
+                self.coordinates = (xs, ys, min(scale, self.lengths[e] / straight * (1 - 2.0 ** -40)))
+
+    # Edge e got shorter (or was just added): if it now gives its target a shorter path, that improvement spreads
+    # out from there exactly like Dijkstra, but only through the nodes it actually improves
+    def repairDecrease( self, e ):
+        if len(self.pred) == 0:
+            return 0
+        dist = self.dist
+        pred = self.pred
+        v = self.targets[e]
+        newDist = dist[self.edges[e].src.node_id] + self.lengths[e]
+        if not newDist < dist[v]:
+            return 0
+        dist[v] = newDist
+        pred[v] = e
+        return self.propagate([(newDist, v)])
+
+    # Edge e got longer (or was deleted). Unless it's in the tree nothing changes. If it is, every node in the
+    # subtree hanging off it has lost its path: each one starts again from the best edge into it from outside the
+    # subtree, and then they settle each other with Dijkstra restricted to the subtree.
+    def repairIncrease( self, e ):
+        if len(self.pred) == 0:
+            return 0
+        dist = self.dist
+        pred = self.pred
+        v = self.targets[e]
+        if pred[v] != e:
+            return 0
+
+        affected = self.subtree(v)
+        for x in affected:
+            dist[x] = float('inf')
+            pred[x] = NO_EDGE
+
+        offsets, sources, lengths, edgeIds = self.reverseGraph()
+        queue = []
+        for x in affected:
+            best = float('inf')
+            bestEdge = NO_EDGE
+            for r in range(offsets[x], offsets[x + 1]):
+                if dist[sources[r]] + lengths[r] < best:
+                    best = dist[sources[r]] + lengths[r]
+                    bestEdge = edgeIds[r]
+            if bestEdge != NO_EDGE:
+                dist[x] = best
+                pred[x] = bestEdge
+                queue.append((best, x))
+        heapq.heapify(queue)
+        self.propagate(queue)
+        return len(affected)
+
+    # Dijkstra from the (distance, node) entries already in queue, over nodes whose dist/pred are already
+    # right everywhere else. Returns how many nodes were settled.
+    def propagate( self, queue ):
+        offsets = self.offsets
+        targets = self.targets
+        lengths = self.lengths
+        dist = self.dist
+        pred = self.pred
+        settled = 0
+        while queue:
+            du, u = heapq.heappop(queue)
+            if du > dist[u]:
+                continue # stale entry
+            settled += 1
+            for e in range(offsets[u], offsets[u + 1]):
+                v = targets[e]
+                if du + lengths[e] < dist[v]:
+                    dist[v] = du + lengths[e]
+                    pred[v] = e
+                    heapq.heappush(queue, (dist[v], v))
+        return settled
+
+    # Every node whose path in the current tree goes through root (root included). The tree's child lists are
+    # worked out from pred with NumPy, so only the subtree itself is walked in Python.
+    def subtree( self, root ):
+        pred = np.frombuffer(self.pred, dtype=np.int64)
+        sources = np.repeat(np.arange(len(self.offsets) - 1, dtype=np.int64),
+                            np.diff(np.frombuffer(self.offsets, dtype=np.int64)))
+        children = np.flatnonzero(pred != NO_EDGE)
+        parents = sources[pred[children]]
+        order = np.argsort(parents, kind='stable')
+        children = children[order].tolist()
+        starts = np.searchsorted(parents[order], np.arange(len(pred) + 1)).tolist()
+
+        nodes = [root]
+        for x in nodes:
+            nodes.extend(children[starts[x]:starts[x + 1]])
+        return nodes
+
+
+# Process pool workers for computeShortestPathsBatch: each copies the CSR arrays out of shared memory once,
+# and opens the output file if there is one
+_batchState = None
+
+def _initBatchWorker(shmName, nodeCount, edgeCount, use_heap, sources, predType, path):
+    global _batchState
+    solver = NetworkRoutingSolver(None)
+    shm = SharedMemory(name=shmName)
+    try:
+        start = 0
+        for name, typecode, count in (('offsets', 'q', nodeCount + 1), ('targets', 'q', edgeCount),
+                                      ('lengths', 'd', edgeCount)):
+            part = array(typecode)
+            part.frombytes(shm.buf[start:start + part.itemsize * count])
+            setattr(solver, name, part)
+            start += part.itemsize * count
+    finally:
+        shm.close()
+    matrix = None if path is None else ShortestPathMatrix(sources, nodeCount, predType, path, mode='r+')
+    _batchState = (solver, use_heap, sources, predType, matrix)
+
+def _batchChunk(rows):
+    solver, use_heap, sources, predType, matrix = _batchState
+    results = []
+    for row in rows:
+        dist, pred = solver.shortestPathTree(sources[row], use_heap)
+        if matrix is None:
+            results.append((row, np.array(dist, dtype=np.float64), np.array(pred, dtype=predType)))
         else:
-            # it's the array, so just return the index of the node that has the shortest distance
-            #this is going to have to be O(|v|) pretty much no matter what
-            minNode = pQueue[0]
-            for node in pQueue:
-                if node.distance < minNode.distance:
-                    minNode = node
-
-            return minNode
-
-
-    # Resorts the minheap so that the node with shortest distance is on top - also adds to the dictionary
-    def bubbleUp(self, pQueue, dict, heapIndex):
-        i = heapIndex  # start bubbling up from the heapIndex passed in
-        while (i // 2) > 0:
-          if pQueue[i].distance < pQueue[i // 2].distance:     #if child is less distance than parent
-             parent = pQueue[i // 2]
-             pQueue[i // 2] = pQueue[i]
-             pQueue[i] = parent
-             #Update the parent/child's heap indices to mirror the swap
-             dict[pQueue[i].node_id] = i
-             dict[pQueue[i // 2].node_id] = i // 2
-          i = i // 2
-
-    # Resorts the minheap so that the min node (which is either the first left or first right child) moves down to the bottom
-    def bubbleDown(self, pQueue, dict, heapIndex):
-        i = heapIndex
-        while (i * 2) <= (len(pQueue)-1):
-            mci = self.pickMinChildIndex(pQueue, i)
-            if pQueue[i].distance > pQueue[mci].distance:
-                parent = pQueue[i]
-                pQueue[i] = pQueue[mci]
-                pQueue[mci] = parent
-
-                # Update the parent/child's heap indices to mirror the swap
-                dict[pQueue[i].node_id] = i
-                dict[pQueue[mci].node_id] = mci
-            i = mci
-
-
-    # Given a node's heap index, returns the INDEX of the child that has the smaller distance value
-    def pickMinChildIndex(self, pQueue, i):
-        if (i * 2 + 1) > (len(pQueue)-1):
-            return i * 2
-        else:
-            if pQueue[i * 2].distance < pQueue[i * 2 + 1].distance:
-                return i * 2
-            else:
-                return i * 2 + 1
+            matrix.dist[row] = dist
+            matrix.pred[row] = pred
+    if matrix is not None:
+        matrix.flush()
+    return results